@@ -1,18 +1,28 @@
 import os
 import sys
 import glob
+import json
+import socket
+import hashlib
+import math
+import time
+import datetime
 import yaml
 import shlex
+import re
 import shutil
-import urllib.request
+import urllib.parse
+import importlib.util
 import asyncio
 import argparse
 import colorama
 import traceback
 import logging
+import collections
 import xml.etree.ElementTree as ElementTree
+from array import array
 from timeit import default_timer as get_elapsed_seconds
-from typing import Tuple, List
+from typing import Tuple, List, Dict, Iterable, Optional, Callable
 
 class Color:
   HEADER = '\033[95m'
@@ -27,18 +37,66 @@ class Color:
 
 # Async OS Process
 
+# ANSI color codes, removed from output lines before matching them
+ANSI_ESCAPE_REGEX = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+class LogMatcher:
+  """Pattern that AsyncProcess scans every output line for as the process runs. event is set on the first
+  matching line, which is kept in first_line. A fatal matcher also fails the whole process, see
+  AsyncProcess.fatal_event."""
+  def __init__(self, name: str, pattern: str, fatal: bool = False):
+    self.name = name
+    self.regex = re.compile(pattern)
+    self.fatal = fatal
+    self.event = asyncio.Event()
+    self.num_matches = 0
+    self.first_line = None
+    self.first_time = None # get_elapsed_seconds() of the first match
+
+  def match(self, line: str) -> bool:
+    if self.regex.search(line) is None:
+      return False
+    self.num_matches += 1
+    if self.first_line is None:
+      self.first_line = line
+      self.first_time = get_elapsed_seconds()
+      self.event.set()
+    return True
+
 class AsyncProcess:
-  def __init__(self, log: logging.Logger, directory: str, command: str, pipe_stdin: bool = False):
+  """Runs a process in the background of the event loop. Only the last max_output_lines lines of stdout
+  and stderr are kept in memory for error reports; the full output can be streamed into log_file, with
+  stderr lines prefixed by '[stderr] '. The lines are scanned for the given LogMatchers while streaming, and
+  fatal_event is set on the first line that matches a fatal one. line_handler gets every line without ANSI
+  color codes as it arrives. Lines are echoed to the debug log unless echo_output is False."""
+  def __init__(self, log: logging.Logger, directory: str, command: str, pipe_stdin: bool = False, log_file: str = None, max_output_lines: int = 1000, matchers: List[LogMatcher] = None, line_handler: Callable[[str], None] = None, echo_output: bool = True):
     self.log = log
     self.directory = directory
     self.command = command
     self.pipe_stdin = pipe_stdin
+    self.log_file = log_file
     self.proc = None
+    self.stdout_lines = collections.deque(maxlen=max_output_lines)
+    self.stderr_lines = collections.deque(maxlen=max_output_lines)
+    self.stdout_line_count = 0
+    self.stderr_line_count = 0
+    self.stdout_bytes = 0
+    self.stderr_bytes = 0
+    self.log_fd = None
+    self.matchers = matchers or []
+    self.line_handler = line_handler
+    self.echo_output = echo_output
+    self.fatal_event = asyncio.Event()
+    self.fatal_line = None
+    self.start_time = None # get_elapsed_seconds() when the process was launched
+    self.started = asyncio.Event() # set once the process has been launched, or has failed to launch
+    self.first_output_time = None # get_elapsed_seconds() of the first output line
 
   async def run(self):
     self.log.info(f'Run process: {self.command}')
     cmd = shlex.split(self.command)
     executable = shutil.which(cmd[0])
+    self.start_time = get_elapsed_seconds()
     try:
       self.proc = await asyncio.create_subprocess_exec(
         executable,
@@ -51,41 +109,84 @@ class AsyncProcess:
     except Exception as ex:
       self.log.error(f'{Color.FAIL}ERROR Failed to execute process "{self.command}": {ex}{Color.ENDC}')
       raise
+    finally:
+      self.started.set()
 
-    self.stdout_lines = []
-    self.stderr_lines = []
-
-    task_stdout = asyncio.create_task(self.stdout_reader())
-    task_stderr = asyncio.create_task(self.stderr_reader())
-    await asyncio.gather(task_stdout, task_stderr)
+    if self.log_file is not None:
+      os.makedirs(os.path.dirname(os.path.abspath(self.log_file)), exist_ok=True)
+      self.log_fd = open(self.log_file, 'w', encoding='utf-8')
+    try:
+      task_stdout = asyncio.create_task(self.stdout_reader())
+      task_stderr = asyncio.create_task(self.stderr_reader())
+      await asyncio.gather(task_stdout, task_stderr)
+    finally:
+      if self.log_fd is not None:
+        self.log_fd.close()
+        self.log_fd = None
 
     self.returncode = await self.proc.wait()
 
   def get_output(self):
-    stdout = '\n'.join(self.stdout_lines)
-    stderr = '\n'.join(self.stderr_lines)
-    return f'<<<\nDIR: {self.directory} COMMAND: {self.command}\n\nSTDOUT:\n{stdout}\nSTDERR:\n{stderr}\n>>>'.replace('\r', '')
+    def formatLines(name: str, lines: collections.deque, line_count: int, num_bytes: int) -> str:
+      header = f'{name} ({line_count} lines, {num_bytes} bytes'
+      if line_count > len(lines):
+        header += f', last {len(lines)} lines shown' + (f', full output in {self.log_file}' if self.log_file is not None else '')
+      return header + '):\n' + '\n'.join(lines)
+    stdout = formatLines('STDOUT', self.stdout_lines, self.stdout_line_count, self.stdout_bytes)
+    stderr = formatLines('STDERR', self.stderr_lines, self.stderr_line_count, self.stderr_bytes)
+    return f'<<<\nDIR: {self.directory} COMMAND: {self.command}\n\n{stdout}\n{stderr}\n>>>'.replace('\r', '')
+
+  def get_matcher(self, name: str) -> Optional[LogMatcher]:
+    return next((matcher for matcher in self.matchers if matcher.name == name), None)
+
+  def format_match_counts(self) -> str:
+    return ', '.join(f'{matcher.num_matches} {matcher.name}' for matcher in self.matchers)
+
+  def scan_line(self, line: str):
+    if self.first_output_time is None:
+      self.first_output_time = get_elapsed_seconds()
+    if '\x1b' in line:
+      line = ANSI_ESCAPE_REGEX.sub('', line)
+    for matcher in self.matchers:
+      if matcher.match(line) and matcher.fatal and self.fatal_line is None:
+        self.fatal_line = line
+        self.log.error(f'{Color.FAIL}Fatal {matcher.name} in output: {line}{Color.ENDC}')
+        self.fatal_event.set()
+    if self.line_handler is not None:
+      self.line_handler(line)
 
   async def stdout_reader(self):
     while True:
       line = await self.proc.stdout.readline()
       if not line:
         break
-      line = line.decode('utf-8').rstrip()
-      self.log.debug(f'  {line}')
+      self.stdout_line_count += 1
+      self.stdout_bytes += len(line)
+      line = line.decode('utf-8', errors='replace').rstrip()
+      if self.echo_output:
+        self.log.debug(f'  {line}')
       self.stdout_lines.append(line)
+      if self.log_fd is not None:
+        self.log_fd.write(line + '\n')
+      self.scan_line(line)
 
   async def stderr_reader(self):
     while True:
       line = await self.proc.stderr.readline()
       if not line:
         break
-      line = line.decode('utf-8').rstrip()
-      self.log.debug(f'  {line}')
+      self.stderr_line_count += 1
+      self.stderr_bytes += len(line)
+      line = line.decode('utf-8', errors='replace').rstrip()
+      if self.echo_output:
+        self.log.debug(f'  {line}')
       self.stderr_lines.append(line)
+      if self.log_fd is not None:
+        self.log_fd.write(f'[stderr] {line}\n')
+      self.scan_line(line)
 
-async def run_process(task_name: str, directory: str, command: str, pipe_stdin: bool = False):
-  proc = AsyncProcess(task_name, directory, command, pipe_stdin)
+async def run_process(task_name: str, directory: str, command: str, pipe_stdin: bool = False, log_file: str = None):
+  proc = AsyncProcess(task_name, directory, command, pipe_stdin, log_file)
   await proc.run()
   return proc
 
@@ -97,6 +198,21 @@ parser.add_argument('--backend-dir', type=str, default='Backend', help='Path to
 parser.add_argument('--results-dir', type=str, default='results', help='Base directory for outputs from the test run (eg, Cypress screenshots), relative to working directory')
 parser.add_argument('--name-prefix', type=str, default='metatest', help='Prefix string to use for docker images and containers')
 parser.add_argument('--use-buildkit', default=False, action='store_true', help='Use legacy docker BuildKit instead of the more modern buildx. At least Bitbucket seems to have spotty support for buildx.')
+parser.add_argument('--build-cache-dir', type=str, default=os.path.join(os.path.expanduser('~'), '.cache', 'metaplay-integration-tests'), help='Directory for the persistent docker layer cache of the test images (not used with --use-buildkit)')
+parser.add_argument('--force-build', default=False, action='store_true', help='Build the test images even if an image with the same build inputs already exists')
+parser.add_argument('--baseline-file', type=str, default='integration-tests-baseline.json', help='Performance baseline that test-bots and test-startup compare their metrics against, relative to working directory')
+parser.add_argument('--update-baseline', default=False, action='store_true', help='Write the metrics of test-bots and test-startup as the new performance baseline instead of comparing against it')
+parser.add_argument('--max-regression', type=float, default=10.0, help='Fail test-bots when CPU or memory per CCU, or test-startup when the time to ready, is higher than the baseline by more than this many percent, with 95%% confidence')
+parser.add_argument('--bot-shards', type=int, default=1, help='Number of botclient containers to split the bots of test-bots over, to generate more load than one botclient can')
+parser.add_argument('--capacity', default=False, action='store_true', help='Make test-bots search for the bot load where the server saturates, instead of running a fixed load')
+parser.add_argument('--capacity-step', type=int, default=200, help='Number of bots added in each stage of the --capacity search')
+parser.add_argument('--capacity-max-bots', type=int, default=5000, help='Stop the --capacity search at this many bots')
+parser.add_argument('--capacity-hold', type=float, default=60.0, help='Seconds to measure each stage of the --capacity search, after its bots have connected')
+parser.add_argument('--capacity-dropoff', type=float, default=20.0, help='Stop the --capacity search when CCU per core drops this many percent below the best stage')
+parser.add_argument('--startup-cycles', type=int, default=5, help='Number of times test-startup starts and stops the game server')
+parser.add_argument('--udp-rate', type=int, default=100, help='Pings per second that test-udp sends to the UDP debug server')
+parser.add_argument('--benchmark', default=False, action='store_true', help='Run test-bots, test-startup and test-udp alone instead of in parallel with other tests, so that their measurements are comparable. Implied by --update-baseline.')
+parser.add_argument('-j', '--jobs', type=int, default=0, help='Maximum number of tests to run in parallel, default is no limit. Tests still wait for the tests they depend on.')
 parser.add_argument('-q', '--quiet', default=False, action='store_true', help='Run quietly, don\'t log the outputs from the process invocations.')
 parser.add_argument('tests', nargs='*', help='List of tests to run, default is to run all tests')
 args = parser.parse_args()
@@ -112,12 +228,20 @@ SERVER_CONTAINER_NAME = f'{args.name_prefix}-server'
 BOTCLIENT_CONTAINER_NAME = f'{args.name_prefix}-botclient'
 DASHBOARD_CONTAINER_NAME = f'{args.name_prefix}-dashboard'
 
+# Port of the server's UDP passthrough debug echo server inside the container
+UDP_DEBUG_SERVER_PORT = 9440
+
 METAPLAY_SDK_DIR = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'), '.').replace('\\','/')
 PROJECT_BACKEND_DIR = os.path.join(args.project_dir, args.backend_dir).replace('\\', '/')
 
 args.backend_dir = args.backend_dir.replace('\\', '/')
 args.project_dir = args.project_dir.replace('\\', '/')
 
+if args.bot_shards < 1:
+  parser.error('--bot-shards must be at least 1')
+if args.startup_cycles < 1:
+  parser.error('--startup-cycles must be at least 1')
+
 if not os.path.exists(os.path.join(args.project_dir, 'Assets')):
   parser.error(f'Unable to find "{args.project_dir}/Assets", make sure your --project-dir is correct!')
 
@@ -168,45 +292,387 @@ def validateYamlFiles(log: logging.Logger, globs):
     if len(matches) == 0:
         raise Exception(f'Failed find any YAML file with {path}')
 
-async def httpGetRequest(log: logging.Logger, url: str) -> str:
-  # \todo [petri] make async
-  response = urllib.request.urlopen(url)
-  log.debug(f'{url} returned {response.getcode()}')
-  if response.getcode() >= 200 and response.getcode() < 300:
-    return response.read().decode('utf-8')
-  else:
-    raise Exception(f'Got code {response.getcode()} when requesting url {url}')
+class HttpResponse:
+  def __init__(self, status: int, headers: Dict[str, str], body: bytes):
+    self.status = status
+    self.headers = headers
+    self.body = body
+
+class AsyncHttpClient:
+  """Minimal HTTP/1.1 client on asyncio streams, so that requests don't block the event loop. Connections
+  are kept alive and reused per host, and each request (including connecting) has a timeout."""
+  MAX_IDLE_CONNECTIONS = 4
+
+  def __init__(self, timeout: float = 10.0):
+    self.timeout = timeout
+    self.idle: Dict[Tuple[str, str, int], List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]] = {}
+
+  async def request(self, method: str, url: str, body: bytes = b'', timeout: float = None) -> HttpResponse:
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+      raise ValueError(f'Unsupported URL scheme in {url}')
+    key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+    path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+    head = f'{method} {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nConnection: keep-alive\r\n'
+    if method != 'GET' or len(body) > 0:
+      head += f'Content-Type: application/x-www-form-urlencoded\r\nContent-Length: {len(body)}\r\n'
+    request = (head + '\r\n').encode('latin-1') + body
+    timeout = self.timeout if timeout is None else timeout
+    try:
+      return await asyncio.wait_for(self._exchange(key, method, request), timeout)
+    except asyncio.TimeoutError:
+      raise TimeoutError(f'HTTP {method} {url} timed out after {timeout}s')
+
+  async def get(self, url: str, timeout: float = None) -> HttpResponse:
+    return await self.request('GET', url, timeout=timeout)
 
-def parsePrometheusMetric(line: str) -> Tuple[str, float]:
-  [name, value] = line.split(' ')
-  return (name, float(value))
+  async def post(self, url: str, body: bytes = b'', timeout: float = None) -> HttpResponse:
+    return await self.request('POST', url, body, timeout)
 
-async def fetchPrometheusMetrics(log: logging.Logger, url: str) -> List[Tuple[str, float]]:
+  async def close(self):
+    for connections in self.idle.values():
+      for (_, writer) in connections:
+        writer.close()
+    self.idle.clear()
+
+  async def _exchange(self, key: Tuple[str, str, int], method: str, request: bytes) -> HttpResponse:
+    while True:
+      idle = self.idle.get(key, [])
+      reused = len(idle) > 0
+      (reader, writer) = idle.pop() if reused else await asyncio.open_connection(key[1], key[2], ssl=True if key[0] == 'https' else None)
+      try:
+        writer.write(request)
+        await writer.drain()
+        (response, keep_alive) = await self._readResponse(reader, method)
+      except (ConnectionError, asyncio.IncompleteReadError):
+        writer.close()
+        # The server may have closed an idle connection, retry those on a new connection
+        if reused:
+          continue
+        raise
+      except BaseException:
+        writer.close()
+        raise
+      if keep_alive and len(self.idle.setdefault(key, [])) < self.MAX_IDLE_CONNECTIONS:
+        self.idle[key].append((reader, writer))
+      else:
+        writer.close()
+      return response
+
+  async def _readResponse(self, reader: asyncio.StreamReader, method: str) -> Tuple[HttpResponse, bool]:
+    status_line = await reader.readline()
+    if not status_line:
+      raise ConnectionResetError('Connection closed by server')
+    (version, status, _) = (status_line.decode('latin-1').rstrip('\r\n') + '  ').split(' ', 2)
+    headers = {}
+    while True:
+      line = await reader.readline()
+      if line in (b'\r\n', b'\n', b''):
+        break
+      (name, value) = line.decode('latin-1').split(':', 1)
+      headers[name.strip().lower()] = value.strip()
+    status = int(status)
+    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+    if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+      body = b''
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+      chunks = []
+      while True:
+        size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+        if size == 0:
+          break
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2) # CRLF after the chunk
+      # Skip trailers
+      while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+        pass
+      body = b''.join(chunks)
+    elif 'content-length' in headers:
+      body = await reader.readexactly(int(headers['content-length']))
+    else:
+      # Body runs until the server closes the connection
+      body = await reader.read()
+      keep_alive = False
+    return (HttpResponse(status, headers, body), keep_alive)
+
+HTTP_CLIENT = AsyncHttpClient()
+
+async def httpGetRequest(log: logging.Logger, url: str) -> str:
+  response = await HTTP_CLIENT.get(url)
+  log.debug(f'{url} returned {response.status}')
+  if response.status >= 200 and response.status < 300:
+    return response.body.decode('utf-8')
+  else:
+    raise Exception(f'Got code {response.status} when requesting url {url}')
+
+# (name, ((label name, label value), ...), value, timestamp in ms or None)
+PrometheusSample = Tuple[str, Tuple[Tuple[str, str], ...], float, Optional[int]]
+
+PROMETHEUS_LABEL_ESCAPES = {'\\': '\\', '"': '"', 'n': '\n'}
+
+def parsePrometheusMetric(line: str) -> PrometheusSample:
+  # Parse a sample line of the Prometheus text format: name{label="value",...} value [timestamp]
+  end = 0
+  while end < len(line) and line[end] not in '{ \t':
+    end += 1
+  name = line[:end]
+  if name == '':
+    raise ValueError(f'Missing metric name in Prometheus sample: {line}')
+  labels = []
+  pos = end
+  if pos < len(line) and line[pos] == '{':
+    pos += 1
+    while True:
+      while pos < len(line) and line[pos] in ' \t,':
+        pos += 1
+      if pos >= len(line):
+        raise ValueError(f'Unterminated labels in Prometheus sample: {line}')
+      if line[pos] == '}':
+        pos += 1
+        break
+      eq = line.find('=', pos)
+      quote = line.find('"', eq)
+      if eq < 0 or quote < 0 or line[eq + 1:quote].strip() != '':
+        raise ValueError(f'Invalid label in Prometheus sample: {line}')
+      label_name = line[pos:eq].strip()
+      value_chars = []
+      pos = quote + 1
+      while pos < len(line) and line[pos] != '"':
+        if line[pos] == '\\' and pos + 1 < len(line):
+          pos += 1
+          value_chars.append(PROMETHEUS_LABEL_ESCAPES.get(line[pos], '\\' + line[pos]))
+        else:
+          value_chars.append(line[pos])
+        pos += 1
+      if pos >= len(line):
+        raise ValueError(f'Unterminated label value in Prometheus sample: {line}')
+      pos += 1
+      labels.append((label_name, ''.join(value_chars)))
+  rest = line[pos:].split()
+  if len(rest) not in (1, 2):
+    raise ValueError(f'Invalid value in Prometheus sample: {line}')
+  # float() also parses the NaN, +Inf and -Inf values
+  return (name, tuple(sorted(labels)), float(rest[0]), int(rest[1]) if len(rest) == 2 else None)
+
+def parsePrometheusText(lines: Iterable[str], types: Dict[str, str] = None) -> Iterable[PrometheusSample]:
+  # Yield the samples of a Prometheus text format exposition line by line. Metric types from the
+  # '# TYPE' comments are stored into types, if given.
+  for line in lines:
+    line = line.strip()
+    if line == '':
+      continue
+    if line.startswith('#'):
+      parts = line.split(None, 3)
+      if types is not None and len(parts) == 4 and parts[1] == 'TYPE':
+        types[parts[2]] = parts[3]
+      continue
+    yield parsePrometheusMetric(line)
+
+def formatSeriesKey(name: str, labels: Tuple[Tuple[str, str], ...]) -> str:
+  if len(labels) == 0:
+    return name
+  escaped = [(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for (label, value) in labels]
+  return name + '{' + ','.join(f'{label}="{value}"' for (label, value) in escaped) + '}'
+
+async def fetchPrometheusSamples(log: logging.Logger, url: str, types: Dict[str, str] = None) -> List[PrometheusSample]:
   response = await httpGetRequest(log, url)
-  lines = response.split('\n')
-  lines = [line for line in lines if not line.startswith('#') and line != '']
-  # if DEBUG:
-  #   print('\n'.join(lines))
-  filtered = [line for line in lines if line.startswith('dotnet_cpu_time_total') or line.startswith('process_cpu_seconds_total') or line.startswith('game_connections_current')]
-  # process_cpu_seconds_total
-  # dotnet_memory_virtual
-  # dotnet_memory_allocated
-  # dotnet_total_memory_bytes
-  # dotnet_gc_loh_size
-  # game_connections_current{type="Tcp"} 0
-  # dotnet_collection_count_total{generation="1"} 1
-  # dotnet_collection_count_total{generation="2"} 1
-  # dotnet_collection_count_total{generation="0"} 1
-  metrics = {}
-  for (name, value) in [parsePrometheusMetric(line) for line in filtered]:
-    metrics[name] = value
-  return metrics
-
-async def testHttpSuccess(log: logging.Logger, url: str):
+  return list(parsePrometheusText(response.split('\n'), types))
+
+class MetricsTimeSeries:
+  """Every series of repeated Prometheus scrapes, stored by column: one column of scrape times, and for
+  each series a column of values aligned with it (NaN when the series was missing from a scrape). Series
+  are grouped by metric name, and types holds the metric types declared by the server."""
+  def __init__(self):
+    self.times = array('d')
+    self.columns: Dict[str, array] = {}
+    self.metric_series: Dict[str, List[str]] = {}
+    self.types: Dict[str, str] = {}
+
+  def record(self, time: float, samples: Iterable[PrometheusSample]):
+    ndx = len(self.times)
+    self.times.append(time)
+    for (name, labels, value, _) in samples:
+      key = formatSeriesKey(name, labels)
+      column = self.columns.get(key)
+      if column is None:
+        column = array('d', [math.nan]) * ndx
+        self.columns[key] = column
+        self.metric_series.setdefault(name, []).append(key)
+      if len(column) > ndx:
+        column[ndx] = value
+      else:
+        column.append(value)
+    for column in self.columns.values():
+      if len(column) <= ndx:
+        column.append(math.nan)
+
+  def isCounter(self, name: str) -> bool:
+    return self.types.get(name) == 'counter' or name.endswith('_total')
+
+  def points(self, key: str, since: float = 0.0) -> List[Tuple[float, float]]:
+    return [(time, value) for (time, value) in zip(self.times, self.columns[key]) if time >= since and not math.isnan(value)]
+
+  def metricTotals(self, name: str, since: float, until: float) -> List[Tuple[float, float]]:
+    # Sum of all the series of a metric at each scrape within [since, until] that has any of them
+    columns = [self.columns[key] for key in self.metric_series.get(name, [])]
+    totals = []
+    for (ndx, time) in enumerate(self.times):
+      if since <= time <= until:
+        values = [column[ndx] for column in columns if not math.isnan(column[ndx])]
+        if len(values) > 0:
+          totals.append((time, sum(values)))
+    return totals
+
+  def counterIncrease(self, name: str, since: float, until: float) -> float:
+    # Increase of the sum of a counter's series from its last scraped value at or before since to its last one at
+    # or before until. Labeled series only appear in scrapes after their first increment, so a series that is
+    # missing at since counts as 0.
+    increase = 0.0
+    for key in self.metric_series.get(name, []):
+      (start_value, end_value) = (0.0, None)
+      for (time, value) in zip(self.times, self.columns[key]):
+        if time > until:
+          break
+        if math.isnan(value):
+          continue
+        if time <= since:
+          start_value = value
+        end_value = value
+      if end_value is not None:
+        increase += end_value - start_value
+    return increase
+
+  def summarize(self, log: logging.Logger, patterns: List[str], since: float = 0.0):
+    # Log counters as their rate per second and gauges as min/avg/max, over the scrapes from 'since' on
+    def formatValue(name: str, value: float) -> str:
+      return f'{value / (1024 * 1024):.1f}MB' if name.endswith('_bytes') or '_bytes_' in name else f'{value:.3f}'
+    for name in sorted(self.metric_series):
+      if not any(pattern in name for pattern in patterns):
+        continue
+      for key in self.metric_series[name]:
+        points = self.points(key, since)
+        if len(points) < 2:
+          continue
+        if self.isCounter(name):
+          ((first_time, first_value), (last_time, last_value)) = (points[0], points[-1])
+          rate = (last_value - first_value) / (last_time - first_time)
+          log.info(f'  {key}: {formatValue(name, rate)}/s (+{formatValue(name, last_value - first_value)} in {last_time - first_time:.0f}s)')
+        else:
+          values = [value for (_, value) in points]
+          log.info(f'  {key}: min={formatValue(name, min(values))} avg={formatValue(name, sum(values) / len(values))} max={formatValue(name, max(values))}')
+
+# Units of the sizes in 'docker stats': decimal for I/O, binary for memory
+DOCKER_SIZE_UNITS = {'B': 1, 'kB': 1e3, 'KB': 1e3, 'MB': 1e6, 'GB': 1e9, 'TB': 1e12, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3, 'TiB': 1024 ** 4}
+
+def parseDockerSize(value: str) -> float:
+  match = re.match(r'([\d.]+)\s*([A-Za-z]+)$', value.strip())
+  if match is None or match[2] not in DOCKER_SIZE_UNITS:
+    raise ValueError(f'Invalid docker size: {value}')
+  return float(match[1]) * DOCKER_SIZE_UNITS[match[2]]
+
+def parseDockerStats(stats: dict) -> List[PrometheusSample]:
+  # One line of 'docker stats --format {{json .}}' as container_* samples labeled with the container name
+  labels = (('container', stats['Name']),)
+  (memory_used, memory_limit) = stats['MemUsage'].split(' / ')
+  (net_rx, net_tx) = stats['NetIO'].split(' / ')
+  (block_read, block_write) = stats['BlockIO'].split(' / ')
+  return [
+    ('container_cpu_cores', labels, float(stats['CPUPerc'].rstrip('%')) / 100, None),
+    ('container_memory_bytes', labels, parseDockerSize(memory_used), None),
+    ('container_memory_limit_bytes', labels, parseDockerSize(memory_limit), None),
+    ('container_network_receive_bytes_total', labels, parseDockerSize(net_rx), None),
+    ('container_network_transmit_bytes_total', labels, parseDockerSize(net_tx), None),
+    ('container_block_read_bytes_total', labels, parseDockerSize(block_read), None),
+    ('container_block_write_bytes_total', labels, parseDockerSize(block_write), None),
+  ]
+
+class DockerStatsSampler:
+  """Streams 'docker stats' of the containers whose names match container_regex into a MetricsTimeSeries,
+  one row per round of stats, timed from start_time like the Prometheus scrapes. docker stats picks up
+  containers that start later on, eg, the botclients. The raw output is not echoed, as it holds terminal
+  control codes and the stats of every container on the host."""
+  STOP_TIMEOUT = 10.0
+
+  def __init__(self, log: logging.Logger, container_regex: str, timeseries: MetricsTimeSeries, start_time: float):
+    self.log = log
+    self.container_regex = re.compile(container_regex)
+    self.timeseries = timeseries
+    self.start_time = start_time
+    self.containers: List[str] = []
+    self.pending: Dict[str, List[PrometheusSample]] = {}
+    self.pending_time = None
+    self.proc = AsyncProcess(log, directory='.', command="docker stats --format '{{json .}}'", max_output_lines=10, line_handler=self.onLine, echo_output=False)
+    self.task = asyncio.create_task(self.proc.run(), name='docker-stats')
+
+  def onLine(self, line: str):
+    try:
+      stats = json.loads(line)
+      if self.container_regex.match(stats['Name']) is None:
+        return
+      samples = parseDockerStats(stats)
+    except (ValueError, KeyError) as e:
+      self.log.debug(f'Ignored docker stats line "{line}": {e}')
+      return
+    # Each round has one line per container, so a container that is already pending starts the next round
+    if stats['Name'] in self.pending:
+      self.flush()
+    if len(self.pending) == 0:
+      self.pending_time = get_elapsed_seconds()
+    if stats['Name'] not in self.containers:
+      self.containers.append(stats['Name'])
+    self.pending[stats['Name']] = samples
+
+  def flush(self):
+    if len(self.pending) > 0:
+      self.timeseries.record(self.pending_time - self.start_time, [sample for samples in self.pending.values() for sample in samples])
+      self.pending = {}
+
+  async def stop(self):
+    # Wait for docker stats to be launched so that it can't start after being stopped
+    try:
+      await asyncio.wait_for(self.proc.started.wait(), self.STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+      self.task.cancel()
+    if self.proc.proc is not None and self.proc.proc.returncode is None:
+      self.proc.proc.terminate()
+    try:
+      await asyncio.wait_for(asyncio.gather(self.task, return_exceptions=True), self.STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+      if self.proc.proc is not None and self.proc.proc.returncode is None:
+        self.log.warning(f'docker stats did not stop in {self.STOP_TIMEOUT:.0f}s, killing it')
+        self.proc.proc.kill()
+        await self.proc.proc.wait()
+    self.flush()
+    if len(self.containers) == 0:
+      self.log.warning(f'No docker stats collected: {self.proc.get_output()}')
+
+  def summarize(self, log: logging.Logger, since: float = 0.0):
+    # Per-container CPU and memory as avg/max, and network I/O as rates, from 'since' on
+    def series(name: str, container: str) -> List[float]:
+      key = formatSeriesKey(name, (('container', container),))
+      return [value for (_, value) in self.timeseries.points(key, since)] if key in self.timeseries.columns else []
+    def rate(name: str, container: str) -> float:
+      key = formatSeriesKey(name, (('container', container),))
+      points = self.timeseries.points(key, since) if key in self.timeseries.columns else []
+      return (points[-1][1] - points[0][1]) / (points[-1][0] - points[0][0]) if len(points) >= 2 else math.nan
+    log.info(f'  {"Container":<48} {"CPU avg/max (cores)":>20} {"Memory avg/max/limit (MB)":>26} {"Net rx/tx (KB/s)":>18}')
+    for container in self.containers:
+      cpu = series('container_cpu_cores', container)
+      memory = series('container_memory_bytes', container)
+      memory_limit = series('container_memory_limit_bytes', container)
+      if len(cpu) == 0 or len(memory) == 0:
+        continue
+      cpu_text = f'{sum(cpu) / len(cpu):.2f}/{max(cpu):.2f}'
+      memory_text = f'{sum(memory) / len(memory) / 1e6:.0f}/{max(memory) / 1e6:.0f}/{memory_limit[-1] / 1e6:.0f}'
+      net_text = f'{rate("container_network_receive_bytes_total", container) / 1e3:.1f}/{rate("container_network_transmit_bytes_total", container) / 1e3:.1f}'
+      log.info(f'  {container:<48} {cpu_text:>20} {memory_text:>26} {net_text:>18}')
+
+async def testHttpSuccess(log: logging.Logger, url: str, timeout: float = None):
   try:
-    response = urllib.request.urlopen(url)
-    log.debug(f'{url} returned {response.getcode()}')
-    if response.getcode() >= 200 and response.getcode() < 300:
+    response = await HTTP_CLIENT.get(url, timeout)
+    log.debug(f'{url} returned {response.status}')
+    if response.status >= 200 and response.status < 300:
       return True
   except Exception as e:
     log.debug(f'Failed to fetch {url}: {e}')
@@ -214,26 +680,93 @@ async def testHttpSuccess(log: logging.Logger, url: str):
 
 async def httpPostRequest(log: logging.Logger, url: str, data=b''):
   try:
-    # \todo [petri] make async
-    request = urllib.request.Request(url, data=data) # provide data to use a POST
-    response = urllib.request.urlopen(request)
-    log.debug(f'{url} returned {response.getcode()}')
-    if response.getcode() >= 200 and response.getcode() < 300:
+    response = await HTTP_CLIENT.post(url, data)
+    log.debug(f'{url} returned {response.status}')
+    if response.status >= 200 and response.status < 300:
       return True
+    log.error(f'HTTP POST to {url} returned {response.status}')
   except Exception as e:
     log.error(f'Failed HTTP POST to {url}: {e}')
   return False
 
-async def runDockerTask(log: logging.Logger, command: str):
-  proc = await run_process(log, directory='.', command=command, pipe_stdin=False)
+async def runDockerTask(log: logging.Logger, command: str, log_file: str = None):
+  proc = await run_process(log, directory='.', command=command, pipe_stdin=False, log_file=log_file)
   if proc.returncode != 0:
     print(f'{Color.FAIL}Docker command "{command}" exited with code {proc.returncode}:{Color.ENDC}\n{proc.get_output()}')
     raise Exception(f'Docker task "{command}" exited with code {proc.returncode}')
   return proc
 
-async def runDockerBuildTask(log: logging.Logger, command: str):
+async def runDockerBuildTask(log: logging.Logger, command: str, log_file: str = None):
   cmd_prefix = 'docker build' if args.use_buildkit else 'docker buildx build --output=type=docker'
-  await runDockerTask(log.getChild('server'), f'{cmd_prefix} {command}')
+  await runDockerTask(log.getChild('server'), f'{cmd_prefix} {command}', log_file)
+
+def hashBuildInputs(paths: List[str]) -> str:
+  # Hash the relative paths and contents of all files under the given paths, in a stable order. Nothing
+  # is skipped: without a .dockerignore, eg, local bin/ and obj/ directories are copied into the image too.
+  digest = hashlib.sha256()
+  for path in sorted(paths):
+    file_paths = [path] if os.path.isfile(path) else []
+    for (dir_path, dir_names, file_names) in os.walk(path):
+      dir_names.sort()
+      file_paths += [os.path.join(dir_path, name) for name in sorted(file_names)]
+    for file_path in file_paths:
+      digest.update(file_path.replace('\\', '/').encode('utf-8') + b'\0')
+      with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+          digest.update(chunk)
+  return digest.hexdigest()
+
+def loadBuildTimes() -> Dict[str, float]:
+  try:
+    with open(os.path.join(args.build_cache_dir, 'build-times.json')) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+def saveBuildTimes(build_times: Dict[str, float]):
+  os.makedirs(args.build_cache_dir, exist_ok=True)
+  with open(os.path.join(args.build_cache_dir, 'build-times.json'), 'w') as f:
+    json.dump(build_times, f, indent=2)
+
+async def supportsLocalBuildCache(log: logging.Logger) -> bool:
+  # The default 'docker' buildx driver can't export caches, only eg, 'docker-container' builders can
+  if args.use_buildkit:
+    return False
+  proc = await run_process(log, directory='.', command='docker buildx inspect')
+  drivers = [line.split(':', 1)[1].strip() for line in proc.stdout_lines if line.startswith('Driver:')]
+  return proc.returncode == 0 and len(drivers) > 0 and drivers[0] != 'docker'
+
+async def runCachedDockerBuildTask(log: logging.Logger, image_name: str, cache_name: str, inputs_hash: str, command: str):
+  # Tag the image also with the hash of its build inputs and skip the build if that tag already exists.
+  # Otherwise build with a local layer cache, written to a new directory that replaces the old one, as
+  # buildx never prunes a local cache in place.
+  hash_tag = f'{image_name.split(":")[0]}:{inputs_hash}'
+  build_times = loadBuildTimes()
+  if not args.force_build:
+    proc = await run_process(log, directory='.', command=f'docker image inspect --format {{{{.Id}}}} {hash_tag}')
+    if proc.returncode == 0:
+      await runDockerTask(log, f'docker tag {hash_tag} {image_name}')
+      saved = f', saved ~{build_times[cache_name]:.0f}s' if cache_name in build_times else ''
+      log.info(f'Build cache hit for {image_name} ({inputs_hash}), skipping build{saved}')
+      return
+  log.info(f'Build cache miss for {image_name} ({inputs_hash}), building')
+
+  cache_dir = os.path.join(args.build_cache_dir, cache_name).replace('\\', '/')
+  cache_args = ''
+  if not await supportsLocalBuildCache(log):
+    log.info('Docker layer cache is not available with --use-buildkit or the default buildx builder, use eg, "docker buildx create --use" to enable it')
+  else:
+    if os.path.exists(cache_dir):
+      cache_args += f'--cache-from type=local,src={cache_dir} '
+    cache_args += f'--cache-to type=local,dest={cache_dir}.new,mode=max '
+  start_time = get_elapsed_seconds()
+  await runDockerBuildTask(log, f'-t {image_name} -t {hash_tag} {cache_args}{command}', log_file=os.path.join(args.results_dir, f'build-{cache_name}.log'))
+  build_times[cache_name] = get_elapsed_seconds() - start_time
+  log.info(f'Built {image_name} in {build_times[cache_name]:.1f}s')
+  if os.path.exists(f'{cache_dir}.new'):
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.rename(f'{cache_dir}.new', cache_dir)
+  saveBuildTimes(build_times)
 
 async def killDockerContainer(log: logging.Logger, container_name: str):
   try:
@@ -241,18 +774,159 @@ async def killDockerContainer(log: logging.Logger, container_name: str):
   except:
     pass
 
+async def runContainerProcess(log: logging.Logger, proc: AsyncProcess, container_name: str) -> AsyncProcess:
+  # Run a 'docker run' process, but kill its container as soon as it logs a fatal error instead of waiting for it to exit
+  run_task = asyncio.create_task(proc.run())
+  fatal_task = asyncio.create_task(proc.fatal_event.wait())
+  try:
+    await asyncio.wait([run_task, fatal_task], return_when=asyncio.FIRST_COMPLETED)
+    if not run_task.done():
+      await killDockerContainer(log, container_name)
+      await run_task
+  finally:
+    fatal_task.cancel()
+  run_task.result()
+  if proc.fatal_line is not None:
+    raise Exception(f'fatal error in log: {proc.fatal_line}')
+  return proc
+
+# Console log lines of the server and botclient look like '[12:34:56.789 ERR Metaplay.Foo] Message' (see
+# LoggingOptions.FormatTemplate), followed by the exception if there is one
+def metaplayLogMatchers() -> List[LogMatcher]:
+  return [
+    LogMatcher('fatal', r'^\[[\d:.]+ FTL ', fatal=True),
+    LogMatcher('unhandled-exception', r'^Unhandled exception\.', fatal=True),
+    LogMatcher('error', r'^\[[\d:.]+ ERR '),
+    LogMatcher('exception', r'^[\w.]+Exception: '),
+  ]
+
+def findFreePorts(count: int, kind: int = socket.SOCK_STREAM) -> List[int]:
+  # Bind all the sockets before closing any of them, so the ports are distinct
+  sockets = []
+  try:
+    for _ in range(count):
+      s = socket.socket(socket.AF_INET, kind)
+      sockets.append(s)
+      s.bind(('', 0))
+    return [s.getsockname()[1] for s in sockets]
+  finally:
+    for s in sockets:
+      s.close()
+
+class TestEnv:
+  """Docker containers and host ports of a single test, so that tests can run in parallel. Containers are
+  named after the test and the game server's HTTP (8888) and metrics (9090) ports are published on free
+  host ports, as is the UDP debug server's port when enabled. Other containers of the test join the
+  server container's network."""
+  def __init__(self, test_name: str, http_port: int, metrics_port: int, udp_port: int):
+    self.test_name = test_name
+    self.server_container_name = f'{SERVER_CONTAINER_NAME}-{test_name}'
+    self.botclient_container_name = f'{BOTCLIENT_CONTAINER_NAME}-{test_name}'
+    self.dashboard_container_name = f'{DASHBOARD_CONTAINER_NAME}-{test_name}'
+    self.http_port = http_port
+    self.metrics_port = metrics_port
+    self.udp_port = udp_port
+
+  @property
+  def server_url(self) -> str:
+    return f'http://localhost:{self.http_port}'
+
+  @property
+  def metrics_url(self) -> str:
+    return f'http://localhost:{self.metrics_port}/metrics'
+
+  @property
+  def container_name_regex(self) -> str:
+    # Names of all the test's containers, including the botclient stages and shards of runBotClient()
+    return rf'({re.escape(self.server_container_name)}|{re.escape(self.botclient_container_name)}(-\d+)?(-shard\d+)?|{re.escape(self.dashboard_container_name)})$'
+
+# Two-sided 95% critical values of Student's t distribution for 1..30 degrees of freedom, 1.96 above that
+T_CRITICAL_95 = [12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23, 2.20, 2.18, 2.16, 2.14, 2.13, 2.12, 2.11, 2.10, 2.09, 2.09, 2.08, 2.07, 2.07, 2.06, 2.06, 2.06, 2.05, 2.05, 2.05, 2.04]
+
+def meanAndVariance(values: List[float]) -> Tuple[float, float]:
+  mean = sum(values) / len(values)
+  return (mean, sum((value - mean) ** 2 for value in values) / (len(values) - 1))
+
+def percentile(values: List[float], p: float) -> float:
+  # Linearly interpolated percentile (0..100) of the values
+  ordered = sorted(values)
+  pos = (len(ordered) - 1) * p / 100
+  lo = math.floor(pos)
+  hi = min(lo + 1, len(ordered) - 1)
+  return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+def compareMeans(current: List[float], baseline: List[float]) -> Tuple[float, float, float]:
+  # Relative change of the current mean from the baseline mean, with its 95% confidence interval from
+  # Welch's t-test: returns (change, low, high)
+  (current_mean, current_var) = meanAndVariance(current)
+  (baseline_mean, baseline_var) = meanAndVariance(baseline)
+  current_se2 = current_var / len(current)
+  baseline_se2 = baseline_var / len(baseline)
+  se2 = current_se2 + baseline_se2
+  if se2 > 0:
+    dof = se2 ** 2 / (current_se2 ** 2 / (len(current) - 1) + baseline_se2 ** 2 / (len(baseline) - 1))
+    t = T_CRITICAL_95[max(0, int(dof) - 1)] if int(dof) <= len(T_CRITICAL_95) else 1.96
+  else:
+    t = 0.0
+  diff = current_mean - baseline_mean
+  half_width = t * math.sqrt(se2)
+  return (diff / baseline_mean, (diff - half_width) / baseline_mean, (diff + half_width) / baseline_mean)
+
+# Per-CCU costs compared against the baseline: (name in the results file, label, unit scale for logging)
+REGRESSION_METRICS = [
+  ('cpu_cores_per_ccu', 'CPU per 1k CCU (cores)', 1000.0),
+  ('memory_bytes_per_ccu', 'Memory per CCU (KB)', 1 / 1024),
+]
+
+def checkPerformanceRegression(log: logging.Logger, results: dict, baseline: dict, metrics: List[Tuple[str, str, float]]) -> List[str]:
+  # Compare the per-sample costs of two results files, returns the descriptions of the regressions
+  regressions = []
+  max_regression = args.max_regression / 100
+  for (name, label, scale) in metrics:
+    current = [sample[name] for sample in results['samples'] if sample.get(name) is not None]
+    previous = [sample[name] for sample in baseline['samples'] if sample.get(name) is not None]
+    if len(current) < 2 or len(previous) < 2:
+      log.warning(f'Not enough samples to compare {label} against the baseline ({len(current)} now, {len(previous)} in baseline)')
+      continue
+    (change, low, high) = compareMeans(current, previous)
+    description = f'{label}: {sum(current) / len(current) * scale:.3f} vs baseline {sum(previous) / len(previous) * scale:.3f}, change {100 * change:+.1f}% (95% CI {100 * low:+.1f}%..{100 * high:+.1f}%)'
+    if low > max_regression:
+      log.error(f'{Color.FAIL}REGRESSION {description}{Color.ENDC}')
+      regressions.append(description)
+    else:
+      log.info(description)
+  return regressions
+
+# Counters of failed logins and sessions, any increase stops a --capacity search
+SESSION_FAILURE_METRICS = ['game_session_start_fails_total', 'game_session_resume_fails_total', 'game_player_login_fails_total']
+
 class BackgroundGameServer:
-  def __init__(self, log, server_proc):
+  PREWARM_TIME = 30.0 # wait 30sec until start accumulating metrics (initial)
+  # Metrics logged by summarizeTimeSeries(), by parts of their names
+  SUMMARY_METRICS = ['process_cpu_seconds_total', 'process_working_set_bytes', 'process_private_memory_bytes', 'dotnet_total_memory_bytes', 'dotnet_collection_count_total', 'dotnet_gc_', 'alloc', 'game_connections_current']
+  # /isReady polling backs off from MIN to MAX_POLL_INTERVAL, and goes back to MIN once the ready line is logged
+  MIN_POLL_INTERVAL = 0.01
+  MAX_POLL_INTERVAL = 0.2
+  SHUTDOWN_TIMEOUT = 30.0 # seconds to wait for a graceful shutdown before killing the container
+
+  def __init__(self, log, env: TestEnv, server_proc):
     self.log = log
+    self.env = env
     self.server_proc = server_proc
+    self.launch_time = get_elapsed_seconds()
+    self.launch_wall_time = time.time()
+    self.timings = {} # startup and shutdown phases in seconds, see startGameServer() and stop()
     self.server_task = asyncio.create_task(server_proc.run(), name='run-gameserver') # create task so process makes progress in background
     self.metrics_task = None
+    self.stats_sampler = None
     self.metrics_samples = []
+    self.timeseries = MetricsTimeSeries() # all scraped series, by seconds since collection start
+    self.metrics_start_time = None
     self.stop_event = asyncio.Event()
 
   async def _collectMetricsAsync(self):
-    prewarm_time = 30.0 # wait 30sec until start accumulating metrics (initial)
-    start_time = get_elapsed_seconds()
+    prewarm_time = self.PREWARM_TIME
+    start_time = self.metrics_start_time
     prev_time = start_time
     prev_cpu_time_total = 0.0
     while not self.stop_event.is_set():
@@ -262,8 +936,9 @@ class BackgroundGameServer:
         except asyncio.TimeoutError:
           pass
         cur_time = get_elapsed_seconds()
-        metrics = await fetchPrometheusMetrics(self.log, 'http://localhost:9090/metrics')
-        # print(metrics)
+        samples = await fetchPrometheusSamples(self.log, self.env.metrics_url, self.timeseries.types)
+        self.timeseries.record(cur_time - start_time, samples)
+        metrics = {formatSeriesKey(name, labels): value for (name, labels, value, _) in samples}
         cpu_time_total = metrics['process_cpu_seconds_total']
         concurrents = sum([metrics[name] for name in metrics if name.startswith('game_connections_current')])
         if concurrents >= 10:
@@ -273,7 +948,7 @@ class BackgroundGameServer:
           use_sample = prev_time - start_time >= prewarm_time # collect samples after pre-warm time has passed
           self.log.info(f'[{cur_time - start_time:.1f}s] Concurrents={int(concurrents)} CPU={cpu_usage_cores:.3f}cores/s CCU/core={concurrents_per_cpu:0.1f} ({"use" if use_sample else "skip"})')
           if use_sample:
-            self.metrics_samples.append((time_elapsed, concurrents, cpu_usage_cores))
+            self.metrics_samples.append((time_elapsed, concurrents, cpu_usage_cores, metrics.get('process_working_set_bytes')))
 
         prev_time = cur_time
         prev_cpu_time_total = cpu_time_total
@@ -282,7 +957,10 @@ class BackgroundGameServer:
         traceback.print_exc()
 
   def startCollectingMetrics(self):
+    # Prometheus scrapes of the server and docker stats of the test's containers, into the same time series
+    self.metrics_start_time = get_elapsed_seconds()
     self.metrics_task = asyncio.create_task(self._collectMetricsAsync())
+    self.stats_sampler = DockerStatsSampler(self.log.getChild('stats'), self.env.container_name_regex, self.timeseries, self.metrics_start_time)
 
   def summarizeMetrics(self):
     num_samples = len(self.metrics_samples)
@@ -293,7 +971,7 @@ class BackgroundGameServer:
     total_time_elapsed = 0.0
     total_concurrents = 0
     total_cpu_usage_cores = 0.0
-    for (time_elapsed, concurrents, cpu_usage_cores) in self.metrics_samples:
+    for (time_elapsed, concurrents, cpu_usage_cores, _) in self.metrics_samples:
       total_time_elapsed += time_elapsed
       total_concurrents += concurrents
       total_cpu_usage_cores += cpu_usage_cores
@@ -302,19 +980,103 @@ class BackgroundGameServer:
     concurrents_per_core = avg_concurrents / avg_cpu_usage_cores
     self.log.info(f'***** Samples={num_samples} Concurrents={avg_concurrents:.1f} CPU={total_cpu_usage_cores:.2f}cores CCU/core={concurrents_per_core}')
 
+  def metricsResults(self, test_name: str) -> dict:
+    # Samples after the pre-warm, with the per-CCU costs that are compared against the baseline
+    samples = []
+    for (time_elapsed, concurrents, cpu_usage_cores, memory_bytes) in self.metrics_samples:
+      samples.append({
+        'time_elapsed': time_elapsed,
+        'concurrents': concurrents,
+        'cpu_cores': cpu_usage_cores,
+        'memory_bytes': memory_bytes,
+        'cpu_cores_per_ccu': cpu_usage_cores / concurrents,
+        'memory_bytes_per_ccu': memory_bytes / concurrents if memory_bytes is not None else None,
+      })
+    summary = {}
+    for name in ['concurrents', 'cpu_cores', 'memory_bytes', 'cpu_cores_per_ccu', 'memory_bytes_per_ccu']:
+      values = [sample[name] for sample in samples if sample[name] is not None]
+      if len(values) > 0:
+        summary[name] = sum(values) / len(values)
+    return {'test': test_name, 'samples': samples, 'summary': summary}
+
+  def measureLoad(self, since: float, until: float) -> Tuple[float, float, float]:
+    # Average CCU, CPU cores used and number of session failures between two get_elapsed_seconds() times
+    (since, until) = (since - self.metrics_start_time, until - self.metrics_start_time)
+    concurrents = [value for (_, value) in self.timeseries.metricTotals('game_connections_current', since, until)]
+    cpu_seconds = self.timeseries.metricTotals('process_cpu_seconds_total', since, until)
+    if len(concurrents) == 0 or len(cpu_seconds) < 2:
+      raise Exception(f'Not enough metrics scraped between {since:.0f}s and {until:.0f}s')
+    ((first_time, first_cpu), (last_time, last_cpu)) = (cpu_seconds[0], cpu_seconds[-1])
+    failures = sum(self.timeseries.counterIncrease(name, since, until) for name in SESSION_FAILURE_METRICS)
+    return (sum(concurrents) / len(concurrents), (last_cpu - first_cpu) / (last_time - first_time), failures)
+
+  def summarizeTimeSeries(self):
+    num_series = len(self.timeseries.columns)
+    self.log.info(f'***** Samples={len(self.timeseries.times)} Series={num_series}, after pre-warm:')
+    self.timeseries.summarize(self.log, self.SUMMARY_METRICS, since=self.PREWARM_TIME)
+    self.log.info('***** Containers, after pre-warm:')
+    self.stats_sampler.summarize(self.log, since=self.PREWARM_TIME)
+
+  def checkAlive(self, context: str):
+    # Raise if the server has logged a fatal error or exited
+    if self.server_proc.fatal_line is not None:
+      self.log.error(f'Server logged a fatal error {context}: {self.server_proc.get_output()}')
+      raise Exception(f'Server logged a fatal error {context}: {self.server_proc.fatal_line}')
+    if self.server_task.done():
+      self.log.error(f'Server exited unexpectedly {context}: {self.server_proc.get_output()}')
+      raise Exception(f'Server exited unexpectedly {context}!')
+
   async def waitForReady(self):
-    # Wait for server /isReady to return success
+    # Wait for server /isReady to return success. The ready line in the server log, fatal errors and the
+    # server exiting all cut the wait between polls short. The time to ready is known to within the last
+    # poll interval, which stays short around the time the server gets ready.
+    ready = self.server_proc.get_matcher('ready')
+    interval = self.MIN_POLL_INTERVAL
+    prev_poll_time = self.launch_time
     while True:
+      self.checkAlive('while waiting for it to be ready')
       self.log.debug('Check server up')
-      if await testHttpSuccess(self.log, 'http://localhost:8888/isReady'):
-        self.log.info(f'Server is ready!')
+      poll_time = get_elapsed_seconds()
+      if await testHttpSuccess(self.log, f'{self.env.server_url}/isReady', timeout=2.0):
+        self.timings['ready'] = poll_time - self.launch_time
+        self.timings['ready_precision'] = poll_time - prev_poll_time
+        self.log.info(f'Server is ready! ({self.timings["ready"]:.3f}s, +-{self.timings["ready_precision"] * 1000:.0f}ms)')
         break
-      else:
-        # Check if server died unexpectedly during init
-        if self.server_task.done():
-          self.log.error(f'Server exited unexpectedly while waiting for it to be ready: <<<{self.server_proc.get_output()}>>>')
-          raise Exception('Server exited unexpectedly while waiting for it to be ready!')
-        await asyncio.sleep(0.2)
+      prev_poll_time = poll_time
+      wakeups = [asyncio.create_task(self.server_proc.fatal_event.wait())]
+      if ready is not None and not ready.event.is_set():
+        wakeups.append(asyncio.create_task(ready.event.wait()))
+      await asyncio.wait(wakeups + [self.server_task], timeout=interval, return_when=asyncio.FIRST_COMPLETED)
+      for task in wakeups:
+        task.cancel()
+      interval = self.MIN_POLL_INTERVAL if ready is not None and ready.event.is_set() else min(2 * interval, self.MAX_POLL_INTERVAL)
+
+    if self.server_proc.first_output_time is not None:
+      self.timings['first_log_line'] = self.server_proc.first_output_time - self.launch_time
+    if ready is not None and ready.first_time is not None:
+      self.timings['ready_log_line'] = ready.first_time - self.launch_time
+
+  async def measureContainerStart(self):
+    # Seconds from launching 'docker run' until docker started the container. Compares the docker host's clock
+    # against ours, so only meaningful with a local docker.
+    proc = await runDockerTask(self.log, f'docker inspect --format {{{{.State.StartedAt}}}} {self.env.server_container_name}')
+    started_at = parseDockerTimestamp(proc.stdout_lines[-1])
+    self.timings['container_start'] = started_at - self.launch_wall_time
+
+  async def guard(self, awaitable):
+    # Run the awaitable (eg, the bots) against the server, but abort it as soon as the server logs a fatal error or exits
+    task = asyncio.ensure_future(awaitable)
+    fatal_task = asyncio.create_task(self.server_proc.fatal_event.wait())
+    try:
+      await asyncio.wait([task, fatal_task, self.server_task], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+      fatal_task.cancel()
+      if not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    if task.cancelled():
+      self.checkAlive('during the test')
+    return task.result()
 
   async def waitFinished(self):
     await asyncio.wait([self.server_task])
@@ -324,54 +1086,146 @@ class BackgroundGameServer:
 
     # wait for metrics collection to stop
     await asyncio.wait([self.metrics_task])
+    await self.stats_sampler.stop()
 
     # print('Sending SIGTERM')
     # self.server_proc.proc.terminate()
     # await asyncio.sleep(2)
     self.log.info('Requesting gameserver graceful shutdown')
-    await httpPostRequest(self.log, 'http://localhost:8888/gracefulShutdown')
-    self.log.info('Killing docker container') # \todo [petri] use SIGTERM instead?
-    await runDockerTask(self.log, f'docker kill {SERVER_CONTAINER_NAME}')
-    self.log.info('Waiting for gameserver to exit')
-    await self.waitFinished()
-
-async def startGameServer(log: logging.Logger):
+    shutdown_start_time = get_elapsed_seconds()
+    if await httpPostRequest(self.log, f'{self.env.server_url}/gracefulShutdown'):
+      await asyncio.wait([self.server_task], timeout=self.SHUTDOWN_TIMEOUT)
+      if self.server_task.done():
+        self.timings['shutdown'] = get_elapsed_seconds() - shutdown_start_time
+        self.log.info(f'Gameserver shut down gracefully in {self.timings["shutdown"]:.2f}s')
+      else:
+        self.log.warning(f'Gameserver did not shut down within {self.SHUTDOWN_TIMEOUT:.0f}s')
+    if not self.server_task.done():
+      self.log.info('Killing docker container') # \todo [petri] use SIGTERM instead?
+      await runDockerTask(self.log, f'docker kill {self.env.server_container_name}')
+      self.log.info('Waiting for gameserver to exit')
+      await self.waitFinished()
+    self.log.info(f'Server log lines: {self.server_proc.format_match_counts()}')
+
+def parseDockerTimestamp(value: str) -> float:
+  # Docker timestamps are RFC 3339 with nanoseconds, eg, '2024-05-06T07:08:09.123456789Z'
+  match = re.match(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)$', value.strip())
+  if match is None:
+    raise Exception(f'Invalid docker timestamp: {value}')
+  timezone = '+00:00' if match[3] == 'Z' else match[3]
+  return datetime.datetime.fromisoformat(match[1] + timezone).timestamp() + float(match[2] or 0.0)
+
+async def startGameServer(log: logging.Logger, env: TestEnv, udp_debug_server: bool = False, log_suffix: str = ''):
   # Kill old server in case it exists
-  await killDockerContainer(log, SERVER_CONTAINER_NAME)
+  await killDockerContainer(log, env.server_container_name)
+
+  # Optionally run the UDP passthrough debug server, which answers the pings of udp-test-tool.py
+  server_opts = METAPLAY_SERVER_OPTS
+  port_args = f'-p {env.http_port}:8888 -p {env.metrics_port}:9090'
+  if udp_debug_server:
+    server_opts += f' --UdpPassthrough:Enabled=true --UdpPassthrough:UseDebugServer=true --UdpPassthrough:LocalServerPort={UDP_DEBUG_SERVER_PORT}'
+    port_args += f' -p {env.udp_port}:{UDP_DEBUG_SERVER_PORT}/udp'
 
   # Start the server
-  log.info('Start game server container')
-  server_proc = AsyncProcess(log, directory='.', command=f'docker run --rm --name {SERVER_CONTAINER_NAME} -e METAPLAY_ENVIRONMENT_FAMILY=Local -p 8888:8888 -p 9090:9090 {SERVER_IMAGE_NAME} gameserver -LogLevel=Information {METAPLAY_OPTS} {METAPLAY_SERVER_OPTS}', pipe_stdin=False)
-  gameserver = BackgroundGameServer(log, server_proc)
+  log.info(f'Start game server container (HTTP port {env.http_port}, metrics port {env.metrics_port}' + (f', UDP port {env.udp_port})' if udp_debug_server else ')'))
+  # The cluster switching to the Running phase is what makes /isReady succeed
+  matchers = metaplayLogMatchers() + [LogMatcher('ready', r'Switching cluster phase from \w+ to Running')]
+  server_proc = AsyncProcess(log, directory='.', command=f'docker run --rm --name {env.server_container_name} -e METAPLAY_ENVIRONMENT_FAMILY=Local {port_args} {SERVER_IMAGE_NAME} gameserver -LogLevel=Information {METAPLAY_OPTS} {server_opts}', pipe_stdin=False, log_file=os.path.join(args.results_dir, f'{env.server_container_name}{log_suffix}.log'), matchers=matchers)
+  gameserver = BackgroundGameServer(log, env, server_proc)
 
-  # Wait until server is ready & start collecting metrics
-  await gameserver.waitForReady()
+  # Wait until server is ready & start collecting metrics. A server that failed to start may still be up.
+  try:
+    await gameserver.waitForReady()
+  except:
+    await killDockerContainer(log, env.server_container_name)
+    await gameserver.waitFinished()
+    raise
   gameserver.startCollectingMetrics()
   return gameserver
 
-async def runBotClient(log: logging.Logger, duration: str, max_bots: int, spawn_rate: int, session_duration: str) -> None:
-  await killDockerContainer(log, BOTCLIENT_CONTAINER_NAME)
-  await runDockerTask(log, f'docker run --rm --name {BOTCLIENT_CONTAINER_NAME} --network container:{SERVER_CONTAINER_NAME} -e METAPLAY_ENVIRONMENT_FAMILY=Local {SERVER_IMAGE_NAME} botclient -LogLevel=Information {METAPLAY_OPTS} --Bot:ServerHost=localhost --Bot:ServerPort=9339 --Bot:EnableTls=false --Bot:CdnBaseUrl=http://localhost:5552/ -ExitAfter={duration} -MaxBots={max_bots} -SpawnRate={spawn_rate} -ExpectedSessionDuration={session_duration}')
-
-async def runCypressTests(log: logging.Logger):
-  await killDockerContainer(log, DASHBOARD_CONTAINER_NAME)
+def splitEvenly(total: int, num_parts: int) -> List[int]:
+  return [total // num_parts + (1 if ndx < total % num_parts else 0) for ndx in range(num_parts)]
+
+def botClientContainerNames(env: TestEnv, max_bots: int, name_suffix: str = '') -> List[str]:
+  # One container per --bot-shards shard that gets any bots
+  num_shards = max(1, min(args.bot_shards, max_bots))
+  if num_shards == 1:
+    return [env.botclient_container_name + name_suffix]
+  return [f'{env.botclient_container_name}{name_suffix}-shard{ndx}' for ndx in range(num_shards)]
+
+async def runBotClient(log: logging.Logger, env: TestEnv, duration: str, max_bots: int, spawn_rate: int, session_duration: str, name_suffix: str = '') -> None:
+  # Run the bots in --bot-shards containers in parallel on the server container's network, each with its
+  # share of the bots and spawn rate. The logs of all shards are streamed into the results dir.
+  container_names = botClientContainerNames(env, max_bots, name_suffix)
+  shard_bots = splitEvenly(max_bots, len(container_names))
+  shard_spawn_rates = [max(1, rate) for rate in splitEvenly(spawn_rate, len(container_names))]
+  await asyncio.gather(*[killDockerContainer(log, name) for name in container_names])
+
+  async def runShard(ndx: int) -> AsyncProcess:
+    shard_log = log.getChild(f'shard{ndx}') if len(container_names) > 1 else log
+    proc = AsyncProcess(shard_log, directory='.', command=f'docker run --rm --name {container_names[ndx]} --network container:{env.server_container_name} -e METAPLAY_ENVIRONMENT_FAMILY=Local {SERVER_IMAGE_NAME} botclient -LogLevel=Information {METAPLAY_OPTS} --Bot:ServerHost=localhost --Bot:ServerPort=9339 --Bot:EnableTls=false --Bot:CdnBaseUrl=http://localhost:5552/ -ExitAfter={duration} -MaxBots={shard_bots[ndx]} -SpawnRate={shard_spawn_rates[ndx]} -ExpectedSessionDuration={session_duration}', log_file=os.path.join(args.results_dir, f'{container_names[ndx]}.log'), matchers=metaplayLogMatchers())
+    try:
+      return await runContainerProcess(shard_log, proc, container_names[ndx])
+    except Exception:
+      # The run has failed already, so stop the other shards right away
+      stopped.update(name for name in container_names if name != container_names[ndx])
+      await asyncio.gather(*[killDockerContainer(log, name) for name in container_names if name != container_names[ndx]])
+      raise
+  stopped = set() # shards killed because another shard failed
+  try:
+    results = await asyncio.gather(*[runShard(ndx) for ndx in range(len(container_names))], return_exceptions=True)
+  except asyncio.CancelledError:
+    # Aborted, eg, because the server failed
+    await asyncio.gather(*[killDockerContainer(log, name) for name in container_names])
+    raise
+
+  failed = []
+  for (container_name, result) in zip(container_names, results):
+    if isinstance(result, BaseException):
+      failed.append(f'{container_name}: {result}')
+    elif container_name in stopped:
+      failed.append(f'{container_name}: stopped')
+    elif result.returncode != 0:
+      print(f'{Color.FAIL}Botclient {container_name} exited with code {result.returncode}:{Color.ENDC}\n{result.get_output()}')
+      failed.append(f'{container_name}: exit code {result.returncode}')
+  if len(container_names) > 1:
+    exit_codes = ', '.join('error' if isinstance(result, BaseException) else str(result.returncode) for result in results)
+    log.info(f'Botclient shards finished with exit codes {exit_codes}, logs in {args.results_dir}')
+  if len(failed) > 0:
+    raise Exception(f'{len(failed)} of {len(container_names)} botclients failed: {"; ".join(failed)}')
+
+async def runCypressTests(log: logging.Logger, env: TestEnv):
+  await killDockerContainer(log, env.dashboard_container_name)
   RESULTS_DIR = os.path.abspath(args.results_dir).replace('\\', '/')
-  await runDockerTask(log, f'docker run --rm --name {DASHBOARD_CONTAINER_NAME} --network container:{SERVER_CONTAINER_NAME} -v {RESULTS_DIR}/cypress:/build/{PROJECT_BACKEND_DIR}/Dashboard/cypress {DASHBOARD_IMAGE_NAME} npx cypress run --browser electron --config baseUrl=http://localhost:5550')
+  try:
+    await runDockerTask(log, f'docker run --rm --name {env.dashboard_container_name} --network container:{env.server_container_name} -v {RESULTS_DIR}/cypress:/build/{PROJECT_BACKEND_DIR}/Dashboard/cypress {DASHBOARD_IMAGE_NAME} npx cypress run --browser electron --config baseUrl=http://localhost:5550', log_file=os.path.join(args.results_dir, f'{env.dashboard_container_name}.log'))
+  except asyncio.CancelledError:
+    await killDockerContainer(log, env.dashboard_container_name)
+    raise
 
 ## Tests
 
 # TEST CASE: Build images
 
-async def testBuildImage(log: logging.Logger):
+async def testBuildImage(log: logging.Logger, env: TestEnv):
   # Ensure all runtime option .yaml files valid
   validateYamlFiles(log.getChild('validate-yaml'), [os.path.join(PROJECT_BACKEND_DIR, 'Server/Config/*.yaml'), os.path.join(PROJECT_BACKEND_DIR, 'BotClient/Config/*.yaml')])
 
+  # Hash the Dockerfile, exactly the paths it COPYs from the build context (with the default dirs of the
+  # build args not given here), and the build args
+  docker_build_args = f'--build-arg SDK_ROOT={METAPLAY_SDK_DIR} --build-arg PROJECT_ROOT={args.project_dir} --build-arg BACKEND_DIR={args.backend_dir} --build-arg DOTNET_VERSION={DOTNET_VERSION} --build-arg RUN_TESTS=1 -f {METAPLAY_SDK_DIR}/Dockerfile.server'
+  hash_start_time = get_elapsed_seconds()
+  sdk_inputs = [os.path.join(METAPLAY_SDK_DIR, name) for name in ['Dockerfile.server', '.editorconfig', 'Backend', 'Client', 'Scripts', 'Frontend']]
+  inputs_hash = hashBuildInputs(sdk_inputs + [PROJECT_BACKEND_DIR, os.path.join(args.project_dir, 'Assets/SharedCode')] + glob.glob('pnpm-*.yaml'))
+  log.info(f'Hashed build inputs in {get_elapsed_seconds() - hash_start_time:.1f}s')
+  def imageHash(target_args: str) -> str:
+    return hashlib.sha256(f'{inputs_hash} {docker_build_args} {target_args}'.encode('utf-8')).hexdigest()[:16]
+
   # Build server image
-  docker_build_args = f'--pull --build-arg SDK_ROOT={METAPLAY_SDK_DIR} --build-arg PROJECT_ROOT={args.project_dir} --build-arg BACKEND_DIR={args.backend_dir} --build-arg DOTNET_VERSION={DOTNET_VERSION} --build-arg RUN_TESTS=1 -f {METAPLAY_SDK_DIR}/Dockerfile.server'
-  await runDockerBuildTask(log.getChild('server'), f'-t {SERVER_IMAGE_NAME} {docker_build_args} .')
+  await runCachedDockerBuildTask(log.getChild('server'), SERVER_IMAGE_NAME, 'server', imageHash(''), f'--pull {docker_build_args} .')
 
   # Build dashboard image
-  await runDockerBuildTask(log.getChild('dashboard'), f'-t {DASHBOARD_IMAGE_NAME} --target build-dashboard {docker_build_args} .')
+  await runCachedDockerBuildTask(log.getChild('dashboard'), DASHBOARD_IMAGE_NAME, 'dashboard', imageHash('--target build-dashboard'), f'--target build-dashboard --pull {docker_build_args} .')
 
   # Start/stop server
   # gameserver = await startGameServer(log.getChild('server'))
@@ -379,29 +1233,246 @@ async def testBuildImage(log: logging.Logger):
 
 # TEST CASE: Run bots
 
-async def testBots(log: logging.Logger):
-  gameserver = await startGameServer(log.getChild('server'))
+async def searchBotCapacity(log: logging.Logger, env: TestEnv, gameserver: BackgroundGameServer):
+  # Add --capacity-step bots in each stage, each stage in its own botclient container, and measure the
+  # load once the new bots have connected. Stop when the server can't keep up: CCU per core drops off,
+  # sessions fail, the CCU doesn't reach the bot count or a botclient exits.
+  spawn_rate = max(30, args.capacity_step // 10)
+  settle_seconds = args.capacity_step / spawn_rate + 15.0
+  curve = [] # (bots, CCU, CPU cores, CCU per core, session failures)
+  bot_tasks = []
+  stop_reason = f'reached {args.capacity_max_bots} bots'
+  saturated = False # whether the last stage of the curve is past the knee
+  try:
+    while (len(bot_tasks) + 1) * args.capacity_step <= args.capacity_max_bots:
+      num_bots = (len(bot_tasks) + 1) * args.capacity_step
+      log.info(f'Capacity stage {len(bot_tasks) + 1}: {num_bots} bots')
+      bot_tasks.append(asyncio.create_task(runBotClient(log.getChild('bots'), env, duration='10:00:00', max_bots=args.capacity_step, spawn_rate=spawn_rate, session_duration='00:00:30', name_suffix=f'-{len(bot_tasks)}')))
+      await asyncio.wait(bot_tasks, timeout=settle_seconds)
+      start_time = get_elapsed_seconds()
+      await asyncio.wait(bot_tasks, timeout=args.capacity_hold)
+      if any(task.done() for task in bot_tasks):
+        stop_reason = 'a botclient exited'
+        break
+
+      (concurrents, cpu_cores, failures) = gameserver.measureLoad(start_time, get_elapsed_seconds())
+      concurrents_per_core = concurrents / cpu_cores if cpu_cores > 0 else 0.0
+      curve.append((num_bots, concurrents, cpu_cores, concurrents_per_core, failures))
+      log.info(f'Bots={num_bots} Concurrents={concurrents:.0f} CPU={cpu_cores:.3f}cores CCU/core={concurrents_per_core:.1f} Failures={failures:.0f}')
+      best_per_core = max(point[3] for point in curve)
+      saturated = True
+      if failures > 0:
+        stop_reason = f'{failures:.0f} session failures'
+        break
+      if concurrents < 0.9 * num_bots:
+        stop_reason = f'only {concurrents:.0f} of {num_bots} bots connected'
+        break
+      if concurrents_per_core < (1 - args.capacity_dropoff / 100) * best_per_core:
+        stop_reason = f'CCU/core dropped to {concurrents_per_core:.1f} from the best {best_per_core:.1f}'
+        break
+      saturated = False
+  finally:
+    # Stopping the stages is expected, cancelled runBotClient()s kill their containers
+    for task in bot_tasks:
+      task.cancel()
+    await asyncio.gather(*bot_tasks, return_exceptions=True)
+
+  # Fleet sizing uses the best stage before the server saturated
+  healthy = curve[:-1] if saturated else curve
+  log.info(f'***** Capacity search stopped: {stop_reason}')
+  log.info('      Bots      CCU   CPU(cores)   CCU/core  Failures')
+  for (num_bots, concurrents, cpu_cores, concurrents_per_core, failures) in curve:
+    log.info(f'  {num_bots:8d} {concurrents:8.0f} {cpu_cores:12.3f} {concurrents_per_core:10.1f} {failures:9.0f}')
+  if len(healthy) > 0:
+    best = max(healthy, key=lambda point: point[3])
+    log.info(f'***** Max CCU/core={best[3]:.1f} (at {best[1]:.0f} CCU), max healthy CCU={healthy[-1][1]:.0f}')
+  else:
+    log.warning('***** No healthy capacity stages, the first stage already saturated the server')
+
+  os.makedirs(args.results_dir, exist_ok=True)
+  results_path = os.path.join(args.results_dir, f'{env.test_name}-capacity.json')
+  with open(results_path, 'w') as f:
+    json.dump({
+      'test': env.test_name,
+      'stop_reason': stop_reason,
+      'curve': [dict(zip(['bots', 'concurrents', 'cpu_cores', 'concurrents_per_core', 'failures'], point)) for point in curve],
+      'max_concurrents_per_core': max(point[3] for point in healthy) if len(healthy) > 0 else None,
+    }, f, indent=2)
+  log.info(f'Wrote capacity curve to {results_path}')
+
+async def testBots(log: logging.Logger, env: TestEnv):
+  gameserver = await startGameServer(log.getChild('server'), env)
+  if args.capacity:
+    try:
+      await gameserver.guard(searchBotCapacity(log, env, gameserver))
+    finally:
+      await gameserver.stop()
+    return
   try:
-    await runBotClient(log.getChild('bots'), duration='00:02:00', max_bots=300, spawn_rate=30, session_duration='00:00:30')
+    await gameserver.guard(runBotClient(log.getChild('bots'), env, duration='00:02:00', max_bots=300, spawn_rate=30, session_duration='00:00:30'))
     gameserver.summarizeMetrics()
+    gameserver.summarizeTimeSeries()
+    checkMetricsResults(log, gameserver.metricsResults(env.test_name))
   finally:
     await gameserver.stop()
 
+def checkMetricsResults(log: logging.Logger, results: dict, metrics: List[Tuple[str, str, float]] = REGRESSION_METRICS):
+  # Write the results into the results dir and either compare them against the baseline, or make them the new baseline
+  os.makedirs(args.results_dir, exist_ok=True)
+  results_path = os.path.join(args.results_dir, f'{results["test"]}-metrics.json')
+  with open(results_path, 'w') as f:
+    json.dump(results, f, indent=2)
+  log.info(f'Wrote metrics to {results_path}')
+
+  # The baseline file holds the results of each test by name
+  baselines = {}
+  if os.path.exists(args.baseline_file):
+    with open(args.baseline_file) as f:
+      baselines = json.load(f)
+
+  if args.update_baseline:
+    if len(results['samples']) < 2:
+      raise Exception(f'Not enough metrics samples ({len(results["samples"])}) for a baseline')
+    baselines[results['test']] = results
+    with open(args.baseline_file, 'w') as f:
+      json.dump(baselines, f, indent=2)
+    log.info(f'Updated performance baseline of {results["test"]} in {args.baseline_file}')
+    return
+
+  if results['test'] not in baselines:
+    log.warning(f'No performance baseline for {results["test"]} in {args.baseline_file}, create it with --update-baseline')
+    return
+  regressions = checkPerformanceRegression(log, results, baselines[results['test']], metrics)
+  if len(regressions) > 0:
+    raise Exception(f'Performance regressed by more than {args.max_regression}% against {args.baseline_file}: {"; ".join(regressions)}')
+
+# TEST CASE: Server startup latency
+
+# Phases of a startup-shutdown cycle in the order they happen, see BackgroundGameServer.timings
+STARTUP_PHASES = [
+  ('container_start', 'Container started'),
+  ('first_log_line', 'First log line'),
+  ('ready_log_line', 'Ready log line'),
+  ('ready', '/isReady success'),
+  ('shutdown', 'Graceful shutdown'),
+]
+
+STARTUP_REGRESSION_METRICS = [
+  ('ready', 'Time to ready (s)', 1.0),
+]
+
+async def testStartup(log: logging.Logger, env: TestEnv):
+  # Start and stop the server --startup-cycles times and report the percentiles of each phase. The times
+  # are from launching 'docker run', except for the shutdown which is from requesting it.
+  samples = []
+  for cycle in range(args.startup_cycles):
+    log.info(f'Startup cycle {cycle + 1}/{args.startup_cycles}')
+    gameserver = await startGameServer(log.getChild('server'), env, log_suffix=f'-cycle{cycle + 1}')
+    try:
+      await gameserver.measureContainerStart()
+    finally:
+      await gameserver.stop()
+    samples.append(gameserver.timings)
+    log.info('Cycle ' + ', '.join(f'{name}={gameserver.timings[name]:.3f}s' for (name, _) in STARTUP_PHASES if name in gameserver.timings))
+
+  log.info(f'***** Startup phases over {len(samples)} cycles (seconds):')
+  log.info(f'  {"Phase":<20} {"p50":>8} {"p90":>8} {"min":>8} {"max":>8}')
+  summary = {}
+  for (name, label) in STARTUP_PHASES:
+    values = [sample[name] for sample in samples if name in sample]
+    if len(values) == 0:
+      continue
+    summary[name] = {'p50': percentile(values, 50), 'p90': percentile(values, 90), 'min': min(values), 'max': max(values)}
+    log.info(f'  {label:<20} {summary[name]["p50"]:8.3f} {summary[name]["p90"]:8.3f} {summary[name]["min"]:8.3f} {summary[name]["max"]:8.3f}')
+  checkMetricsResults(log, {'test': env.test_name, 'samples': samples, 'summary': summary}, STARTUP_REGRESSION_METRICS)
+
+# TEST CASE: UDP latency under bot load
+
+def loadUdpTestTool():
+  # udp-test-tool.py lives next to this script, and its name is not a valid module name
+  spec = importlib.util.spec_from_file_location('udp_test_tool', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'udp-test-tool.py'))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+async def testUdpUnderLoad(log: logging.Logger, env: TestEnv):
+  # Ping the server's UDP debug server with the probe of udp-test-tool.py while the bots ramp up, and report
+  # the ping and loss between each two Prometheus scrapes against the CCU of the scrapes
+  udp = loadUdpTestTool()
+  gameserver = await startGameServer(log.getChild('server'), env, udp_debug_server=True)
+  try:
+    windows = [] # (window end in seconds of the metrics time series, WindowStats)
+    wall_clock_offset = time.time() - get_elapsed_seconds()
+    def onWindow(second: int, end_wall_clock_ns: int, stats):
+      windows.append((end_wall_clock_ns / 1e9 - wall_clock_offset - gameserver.metrics_start_time, stats.copy()))
+    udp_probe = udp.UdpProbe('127.0.0.1', env.udp_port, packet_len=100, packet_rate=args.udp_rate, max_burst=udp.default_max_burst(args.udp_rate), report=log.getChild('udp').info, label='server', on_window=onWindow)
+    for attempt in range(3):
+      try:
+        await udp_probe.connect()
+        break
+      except asyncio.TimeoutError:
+        if attempt == 2:
+          raise Exception(f'No reply from the UDP debug server at port {env.udp_port}')
+
+    probe_task = asyncio.create_task(udp_probe.run())
+    try:
+      await gameserver.guard(runBotClient(log.getChild('bots'), env, duration='00:02:00', max_bots=500, spawn_rate=5, session_duration='00:05:00'))
+    finally:
+      probe_task.cancel()
+      await asyncio.gather(probe_task, return_exceptions=True)
+    udp_probe.print_summary()
+  finally:
+    await gameserver.stop()
+
+  # Merge the one-second windows into the intervals between scrapes, with the average CCU of the interval's ends
+  concurrents = gameserver.timeseries.metricTotals('game_connections_current', 0.0, math.inf)
+  curve = [] # (CCU, WindowStats)
+  for ((scrape_start, start_concurrents), (scrape_end, end_concurrents)) in zip(concurrents, concurrents[1:]):
+    stats = udp.WindowStats()
+    for (window_end, window) in windows:
+      if scrape_start < window_end - 0.5 <= scrape_end:
+        stats.merge(window)
+    if stats.num_sent > 0:
+      curve.append(((start_concurrents + end_concurrents) / 2, stats))
+  if len(curve) == 0:
+    raise Exception('No UDP ping windows between the metrics scrapes')
+
+  log.info('***** UDP ping (ms) against CCU:')
+  log.info(f'  {"CCU":>6} {"Sent":>7} {"Loss%":>7} {"p50":>8} {"p90":>8} {"p99":>8} {"p99.9":>8} {"max":>8}')
+  results = []
+  for (ccu, stats) in curve:
+    loss_percent = 100 * stats.num_lost / stats.num_sent
+    percentiles_ms = [None if value_ns is None else value_ns / 1e6 for value_ns in stats.latency.percentiles_ns()]
+    max_ms = stats.latency.max_ns / 1e6 if stats.num_received > 0 else None
+    log.info(f'  {ccu:6.0f} {stats.num_sent:7d} {loss_percent:7.2f} ' + ' '.join('     n/a' if value is None else f'{value:8.2f}' for value in percentiles_ms + [max_ms]))
+    results.append({'concurrents': ccu, 'sent': stats.num_sent, 'lost': stats.num_lost, 'loss_percent': loss_percent, 'ping_ms': dict(zip([str(p) for p in udp.HISTOGRAM_PERCENTILES], percentiles_ms)), 'max_ping_ms': max_ms})
+
+  os.makedirs(args.results_dir, exist_ok=True)
+  results_path = os.path.join(args.results_dir, f'{env.test_name}-udp.json')
+  with open(results_path, 'w') as f:
+    json.dump({'test': env.test_name, 'packet_rate': args.udp_rate, 'curve': results}, f, indent=2)
+  log.info(f'Wrote UDP ping curve to {results_path}')
+
 # TEST CASE: Dashboard (Cypress) tests
 
-async def testDashboard(log: logging.Logger):
-  gameserver = await startGameServer(log.getChild('server'))
+async def testDashboard(log: logging.Logger, env: TestEnv):
+  gameserver = await startGameServer(log.getChild('server'), env)
   try:
-    await runCypressTests(log.getChild('dashboard'))
+    await gameserver.guard(runCypressTests(log.getChild('dashboard'), env))
   finally:
     await gameserver.stop()
 
 ## Main
 
+# (name, test function, names of the tests that must succeed before it starts, is benchmark). Tests run in parallel
+# once their dependencies are done; dependencies that are not selected to run are assumed to be up to date.
+# With --benchmark, the benchmarks run exclusively: each takes all the job slots, so no other test skews its measurements.
 TEST_SPECS = [
-  ('build-image', testBuildImage),
-  ('test-bots', testBots),
-  ('test-dashboard', testDashboard),
+  ('build-image', testBuildImage, [], False),
+  ('test-bots', testBots, ['build-image'], True),
+  ('test-startup', testStartup, ['build-image'], True),
+  ('test-udp', testUdpUnderLoad, ['build-image'], True),
+  ('test-dashboard', testDashboard, ['build-image'], False),
 ]
 
 # Configure logging
@@ -411,20 +1482,79 @@ logging.basicConfig(
   datefmt='%Y-%m-%d %H:%M:%S')
 
 async def main():
-  for (test_name, test_fn) in TEST_SPECS:
+  selected = [spec for spec in TEST_SPECS if len(args.tests) == 0 or spec[0] in args.tests]
+  for (test_name, _, _, _) in TEST_SPECS:
+    if test_name not in [name for (name, _, _, _) in selected]:
+      logging.getLogger(test_name).warning(f'Skip test: {test_name}')
+  if len(selected) == 0:
+    return
+
+  ports = findFreePorts(2 * len(selected))
+  udp_ports = findFreePorts(len(selected), socket.SOCK_DGRAM)
+  envs = {test_name: TestEnv(test_name, ports[2 * ndx], ports[2 * ndx + 1], udp_ports[ndx]) for (ndx, (test_name, _, _, _)) in enumerate(selected)}
+  num_job_slots = args.jobs if args.jobs > 0 else len(selected)
+  job_slots = asyncio.Semaphore(num_job_slots)
+  exclusive_lock = asyncio.Lock() # so that exclusive tests don't each end up holding part of the slots
+  tasks: Dict[str, asyncio.Task] = {}
+  results: Dict[str, str] = {}
+  durations: Dict[str, float] = {}
+
+  async def acquireJobSlots(exclusive: bool) -> int:
+    if not exclusive:
+      await job_slots.acquire()
+      return 1
+    async with exclusive_lock:
+      for _ in range(num_job_slots):
+        await job_slots.acquire()
+    return num_job_slots
+
+  async def runTest(test_name: str, test_fn, depends_on: List[str], exclusive: bool):
     log = logging.getLogger(test_name)
-    should_run = len(args.tests) == 0 or test_name in args.tests
-    if should_run:
+    dep_tasks = [tasks[dep] for dep in depends_on if dep in tasks]
+    if len(dep_tasks) > 0:
+      await asyncio.wait(dep_tasks)
+    failed_deps = [dep for dep in depends_on if results.get(dep, 'success') != 'success']
+    if len(failed_deps) > 0:
+      log.warning(f'Skip test: {test_name}, it depends on {", ".join(failed_deps)}')
+      results[test_name] = 'skipped'
+      return
+    num_slots = await acquireJobSlots(exclusive)
+    try:
+      # Don't start new tests after a failure, but let the running ones finish and clean up
+      if 'failed' in results.values():
+        log.warning(f'Skip test: {test_name}, another test failed')
+        results[test_name] = 'skipped'
+        return
+      start_time = get_elapsed_seconds()
       try:
-        log.info(f'Running test: {test_name}')
-        await test_fn(log)
+        log.info(f'Running test: {test_name}' + (' (exclusive)' if exclusive else ''))
+        await test_fn(log, envs[test_name])
         log.info(f'{Color.OKGREEN}Test {test_name} success{Color.ENDC}')
+        results[test_name] = 'success'
       except Exception as e:
         log.error(f'{Color.FAIL}Test {test_name} failed with: {e}{Color.ENDC}')
         traceback.print_exc() # print the stack trace so we know what failed
-        sys.exit(1)
-    else:
-      log.warning(f'Skip test: {test_name}')
+        results[test_name] = 'failed'
+      durations[test_name] = get_elapsed_seconds() - start_time
+    finally:
+      for _ in range(num_slots):
+        job_slots.release()
+
+  start_time = get_elapsed_seconds()
+  for (test_name, test_fn, depends_on, is_benchmark) in selected:
+    exclusive = is_benchmark and (args.benchmark or args.update_baseline)
+    tasks[test_name] = asyncio.create_task(runTest(test_name, test_fn, depends_on, exclusive), name=test_name)
+  await asyncio.wait(tasks.values())
+  elapsed = get_elapsed_seconds() - start_time
+  await HTTP_CLIENT.close()
+
+  log = logging.getLogger('main')
+  for (test_name, _, _, _) in selected:
+    duration = f' in {durations[test_name]:.1f}s' if test_name in durations else ''
+    log.info(f'{test_name}: {results[test_name]}{duration}')
+  log.info(f'Ran {len(durations)} tests in {elapsed:.1f}s, {sum(durations.values()):.1f}s when run one after another')
+  if any(result != 'success' for result in results.values()):
+    sys.exit(1)
 
 if __name__ == '__main__':
   colorama.init()
@@ -0,0 +1,180 @@
+import socket
+import sys
+import heapq
+import random
+import selectors
+import multiprocessing
+import time
+from argparse import ArgumentParser
+
+# Max datagrams to read per readiness event before serving due delayed replies
+MAX_BATCH_DATAGRAMS = 256
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
+class Impairments:
+  """Artificial network impairments applied to the pong replies. Delays are in nanoseconds and
+  probabilities in 0..1; a reordered reply is held back by reorder_delay_ns on top of its delay."""
+  def __init__(self, delay_ns, jitter_ns, loss, reorder, reorder_delay_ns):
+    self.delay_ns = delay_ns
+    self.jitter_ns = jitter_ns
+    self.loss = loss
+    self.reorder = reorder
+    self.reorder_delay_ns = reorder_delay_ns
+
+  def is_passthrough(self):
+    return self.delay_ns == 0 and self.jitter_ns == 0 and self.loss == 0 and self.reorder == 0
+
+def open_socket(host, port, reuse_port):
+  s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  if reuse_port:
+    # Each worker binds its own socket to the same port and the kernel spreads the clients over them
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+  s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+  s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, RECEIVE_BUFFER_SIZE)
+  s.bind((host, port))
+  s.setblocking(False)
+  return s
+
+def serve(worker_ndx, host, port, reuse_port, impairments, seed, print_stats):
+  s = open_socket(host, port, reuse_port)
+  rng = random.Random(None if seed is None else seed + worker_ndx)
+  passthrough = impairments.is_passthrough()
+  selector = selectors.DefaultSelector()
+  selector.register(s, selectors.EVENT_READ)
+  buffer = bytearray(65536)
+  view = memoryview(buffer)
+  delayed = [] # heap of (due_ns, order, reply, addr)
+  num_delayed = 0
+  num_received = 0
+  num_replied = 0
+  num_dropped = 0
+  stats_at = time.monotonic() + 1.0
+
+  while True:
+    timeout = None
+    if len(delayed) > 0:
+      timeout = max(0.0, (delayed[0][0] - time.perf_counter_ns()) / 1_000_000_000)
+    if print_stats:
+      timeout = max(0.0, stats_at - time.monotonic()) if timeout is None else min(timeout, max(0.0, stats_at - time.monotonic()))
+
+    if len(selector.select(timeout)) > 0:
+      # Drain a batch of datagrams per wakeup. Replies without impairments are rewritten in place and sent
+      # right away, the rest are copied to the delay queue.
+      for _ in range(MAX_BATCH_DATAGRAMS):
+        try:
+          (length, addr) = s.recvfrom_into(buffer)
+        except (BlockingIOError, InterruptedError):
+          break
+        except OSError:
+          continue # eg, ICMP port unreachable from a client that went away
+        num_received += 1
+        if length == 8 and buffer[0:8] == b"pinghelo":
+          try:
+            s.sendto(b"ponghelo", addr)
+          except OSError:
+            num_dropped += 1 # eg, send buffer full
+          continue
+        if length < 4 or buffer[0:4] != b"ping":
+          continue
+        buffer[0:4] = b"pong"
+        if passthrough:
+          try:
+            s.sendto(view[:length], addr)
+            num_replied += 1
+          except OSError:
+            num_dropped += 1
+          continue
+        if rng.random() < impairments.loss:
+          num_dropped += 1
+          continue
+        delay_ns = impairments.delay_ns
+        if impairments.jitter_ns > 0:
+          delay_ns += int(rng.random() * impairments.jitter_ns)
+        if impairments.reorder > 0 and rng.random() < impairments.reorder:
+          delay_ns += impairments.reorder_delay_ns
+        if delay_ns == 0:
+          try:
+            s.sendto(view[:length], addr)
+            num_replied += 1
+          except OSError:
+            num_dropped += 1
+        else:
+          heapq.heappush(delayed, (time.perf_counter_ns() + delay_ns, num_delayed, bytes(view[:length]), addr))
+          num_delayed += 1
+
+    now = time.perf_counter_ns()
+    while len(delayed) > 0 and delayed[0][0] <= now:
+      (_, _, reply, addr) = heapq.heappop(delayed)
+      try:
+        s.sendto(reply, addr)
+        num_replied += 1
+      except OSError:
+        num_dropped += 1
+
+    if print_stats and time.monotonic() >= stats_at:
+      stats_at += 1.0
+      print(f"[worker {worker_ndx}] received {num_received}, replied {num_replied}, dropped {num_dropped}, queued {len(delayed)}")
+      sys.stdout.flush()
+      num_received = 0
+      num_replied = 0
+      num_dropped = 0
+
+def run_worker(worker_ndx, host, port, reuse_port, impairments, seed, print_stats):
+  try:
+    serve(worker_ndx, host, port, reuse_port, impairments, seed, print_stats)
+  except KeyboardInterrupt:
+    pass
+
+def main():
+  parser = ArgumentParser(description='Metaplay Debug UDP echo server, the counterpart of udp-test-tool.py.')
+  parser.add_argument('port', nargs=1)
+  parser.add_argument('-bind', default='0.0.0.0', help="Address to listen on")
+  parser.add_argument('-workers', default=1, help="Number of worker processes sharing the port with SO_REUSEPORT")
+  parser.add_argument('-delay', default=0.0, help="Delay every reply by this many milliseconds")
+  parser.add_argument('-jitter', default=0.0, help="Delay every reply by a random 0..N milliseconds on top of -delay")
+  parser.add_argument('-loss', default=0.0, help="Drop this percentage of the replies")
+  parser.add_argument('-reorder', default=0.0, help="Hold back this percentage of the replies by -reorder-delay so they arrive out of order")
+  parser.add_argument('-reorder-delay', default=5.0, help="Extra delay in milliseconds for reordered replies")
+  parser.add_argument('-seed', default=None, help="Random seed for reproducible loss, jitter and reordering")
+  parser.add_argument('-stats', default=False, action='store_true', help="Print per-worker packet counts every second")
+
+  args = parser.parse_args()
+  port = int(args.port[0])
+  num_workers = int(args.workers)
+  if num_workers < 1:
+    parser.error("-workers must be at least 1")
+  reuse_port = num_workers > 1
+  if reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+    parser.error("-workers above 1 needs SO_REUSEPORT, which this platform does not have")
+  impairments = Impairments(
+    delay_ns = int(float(args.delay) * 1_000_000),
+    jitter_ns = int(float(args.jitter) * 1_000_000),
+    loss = float(args.loss) / 100,
+    reorder = float(args.reorder) / 100,
+    reorder_delay_ns = int(float(args.reorder_delay) * 1_000_000))
+  seed = None if args.seed is None else int(args.seed)
+
+  print(f"UDP echo server listening on {args.bind}:{port} with {num_workers} worker(s)")
+  print(f" Delay: {args.delay}ms + jitter 0..{args.jitter}ms")
+  print(f" Loss: {args.loss}%, reorder: {args.reorder}% by {args.reorder_delay}ms")
+  sys.stdout.flush()
+
+  if num_workers == 1:
+    run_worker(0, args.bind, port, reuse_port, impairments, seed, args.stats)
+    return
+
+  workers = [multiprocessing.Process(target=run_worker, args=(ndx, args.bind, port, reuse_port, impairments, seed, args.stats), daemon=True) for ndx in range(num_workers)]
+  for worker in workers:
+    worker.start()
+  try:
+    for worker in workers:
+      worker.join()
+  except KeyboardInterrupt:
+    pass
+  for worker in workers:
+    worker.join(timeout=1)
+    if worker.is_alive():
+      worker.terminate()
+
+if __name__ == '__main__':
+  main()
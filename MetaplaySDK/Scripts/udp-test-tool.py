@@ -1,11 +1,15 @@
 import socket
 import sys
-import os
 import struct
 from argparse import ArgumentParser
-import threading
+import asyncio
+import multiprocessing
+import queue
 import time
 import math
+import mmap
+import bisect
+from array import array
 
 def ask_raw(s, msg, ip, port):
   s.sendto(msg, (ip, port))
@@ -28,191 +32,1288 @@ def bandwidth_str(size):
      return f"{size/1000:.1f} kB/s"
   return f"{size/1000_000:.2f} MB/s"
 
-def analyze_range(write_buf, read_buf, time_start, time_end):
-  ping_in_range = {}
-  for id, ts in write_buf.items():
-    if ts < time_start or ts >= time_end:
-      continue
-    ping_in_range[id] = ts
-
-  ping_pong_in_range = []
-  for (id, send_ts) in ping_in_range.items():
-    if id in read_buf:
-      ping_pong_in_range.append((id, send_ts, read_buf[id], read_buf[id] - send_ts))
-
-  num_sent = len(ping_in_range)
-  num_lost = len(ping_in_range) - len(ping_pong_in_range)
-
-  num_reorders = 0
-  pong_id_order = list(read_buf.keys())
-  for ndx in range(1, len(ping_pong_in_range)):
-    prec_id = ping_pong_in_range[ndx - 1][0]
-    succ_id = ping_pong_in_range[ndx][0]
-    if pong_id_order.index(prec_id) > pong_id_order.index(succ_id):
+class ArrivalTracker:
+  """Tracks the arrival order of replies by sequence number. A reply is reordered if a reply with a
+  higher sequence number has already arrived; its reorder distance is how many sequence numbers
+  behind the highest received one it is. O(1) per reply."""
+  def __init__(self):
+    self.highest_seq = -1
+
+  def on_arrival(self, seq):
+    if seq > self.highest_seq:
+      self.highest_seq = seq
+      return 0
+    return self.highest_seq - seq
+
+class Pacer:
+  """Token bucket send pacer. Tokens accrue at the target rate and are spent in bursts of at most
+  max_burst packets; tokens beyond that are dropped if the sender falls behind. Between bursts the
+  sender sleeps until the next token is due, minus the measured timer oversleep (slack), so it
+  neither spins nor lags behind the schedule."""
+  def __init__(self, packet_rate, max_burst, start_ns):
+    self.ns_per_packet = 1_000_000_000 / packet_rate
+    self.max_burst = max_burst
+    self.next_send_ns = start_ns
+    self.slack_ns = 0
+    self.num_sent = 0
+    self.num_bursts = 0
+    self.num_dropped = 0
+
+  def set_rate(self, packet_rate, max_burst, now_ns):
+    # Restart the schedule from now at the new rate
+    self.ns_per_packet = 1_000_000_000 / packet_rate
+    self.max_burst = max_burst
+    self.next_send_ns = now_ns
+
+  def num_due(self, now_ns):
+    if now_ns < self.next_send_ns:
+      return 0
+    num_due = int((now_ns - self.next_send_ns) / self.ns_per_packet) + 1
+    if num_due > self.max_burst:
+      self.num_dropped += num_due - self.max_burst
+      self.next_send_ns += (num_due - self.max_burst) * self.ns_per_packet
+      num_due = self.max_burst
+    return num_due
+
+  def on_sent(self, num_sent):
+    self.next_send_ns += num_sent * self.ns_per_packet
+    self.num_sent += num_sent
+    self.num_bursts += 1
+
+  def sleep_ns(self, now_ns):
+    # How long to sleep until the next token, compensated for the typical oversleep. If the token
+    # is due within the slack, sleep anyway and let the bucket absorb the lateness instead of spinning.
+    sleep_ns = self.next_send_ns - now_ns - self.slack_ns
+    return sleep_ns if sleep_ns > 0 else max(0, self.next_send_ns - now_ns)
+
+  def on_slept(self, sleep_ns, slept_ns):
+    self.slack_ns += (slept_ns - sleep_ns - self.slack_ns) / 8
+
+class PacketRing:
+  """Preallocated ring buffers of per-packet send and receive timestamps, indexed by sequence number
+  modulo capacity. The writer is the only one to touch send_ns and the reader the only one to touch
+  recv_ns and reorder_dist, and single element stores into an array are atomic, so no locking is needed.
+  A receive timestamp of 0 means no reply has arrived (yet)."""
+  def __init__(self, min_capacity):
+    capacity = 1024
+    while capacity < min_capacity:
+      capacity *= 2
+    self.capacity = capacity
+    self.mask = capacity - 1
+    self.send_ns = array("q", bytes(8 * capacity))
+    self.recv_ns = array("q", bytes(8 * capacity))
+    self.reorder_dist = array("q", bytes(8 * capacity))
+    self.num_sent = 0
+
+  def on_send(self, seq, send_ns):
+    # Reset the slot before publishing the packet, so the reader never sees the stale reply of seq - capacity
+    ndx = seq & self.mask
+    self.recv_ns[ndx] = 0
+    self.reorder_dist[ndx] = 0
+    self.send_ns[ndx] = send_ns
+    self.num_sent = seq + 1
+
+  def on_receive(self, seq, recv_ns, reorder_dist):
+    # Ignore replies to packets that were never sent or have already been overwritten, and duplicates
+    if seq < 0 or seq >= self.num_sent or seq < self.num_sent - self.capacity:
+      return False
+    ndx = seq & self.mask
+    if self.recv_ns[ndx] != 0:
+      return False
+    self.reorder_dist[ndx] = reorder_dist
+    self.recv_ns[ndx] = recv_ns
+    return True
+
+# Latency histogram precision: 2^7 linear sub-buckets per power of two (<1.6% error), in microseconds up to 2^32us
+HISTOGRAM_SUB_BUCKET_BITS = 7
+HISTOGRAM_MAX_VALUE_BITS = 32
+HISTOGRAM_PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+class LatencyHistogram:
+  """Fixed-size, log-bucketed latency histogram in the style of HdrHistogram. Recording a value is
+  O(1) and allocates nothing; count, mean, stddev, min and max are tracked exactly next to the buckets
+  and percentiles are resolved to the upper bound of their bucket."""
+  def __init__(self):
+    half_bits = HISTOGRAM_SUB_BUCKET_BITS - 1
+    self.num_buckets = (HISTOGRAM_MAX_VALUE_BITS - HISTOGRAM_SUB_BUCKET_BITS + 2) << half_bits
+    self.counts = array("q", bytes(8 * self.num_buckets))
+    self.min_ndx = self.num_buckets
+    self.max_ndx = -1
+    self.clear()
+
+  def clear(self):
+    counts = self.counts
+    for ndx in range(self.min_ndx, self.max_ndx + 1):
+      counts[ndx] = 0
+    self.count = 0
+    self.mean_ns = 0.0
+    self.m2_ns = 0.0
+    self.min_ns = None
+    self.max_ns = None
+    self.min_ndx = self.num_buckets
+    self.max_ndx = -1
+
+  @staticmethod
+  def bucket_index(value_ns):
+    value = min(max(value_ns, 0) // 1000, (1 << HISTOGRAM_MAX_VALUE_BITS) - 1)
+    shift = max(0, value.bit_length() - HISTOGRAM_SUB_BUCKET_BITS)
+    return (shift << (HISTOGRAM_SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+  @staticmethod
+  def bucket_upper_bound_ns(ndx):
+    half_bits = HISTOGRAM_SUB_BUCKET_BITS - 1
+    shift = max(0, (ndx >> half_bits) - 1)
+    sub_bucket = ndx - (shift << half_bits)
+    return (((sub_bucket + 1) << shift) - 1) * 1000
+
+  def record(self, value_ns):
+    ndx = self.bucket_index(value_ns)
+    self.counts[ndx] += 1
+    if ndx < self.min_ndx:
+      self.min_ndx = ndx
+    if ndx > self.max_ndx:
+      self.max_ndx = ndx
+    self.count += 1
+    delta = value_ns - self.mean_ns
+    self.mean_ns += delta / self.count
+    self.m2_ns += delta * (value_ns - self.mean_ns)
+    if self.min_ns is None or value_ns < self.min_ns:
+      self.min_ns = value_ns
+    if self.max_ns is None or value_ns > self.max_ns:
+      self.max_ns = value_ns
+
+  def merge(self, other):
+    if other.count == 0:
+      return
+    counts = self.counts
+    other_counts = other.counts
+    for ndx in range(other.min_ndx, other.max_ndx + 1):
+      counts[ndx] += other_counts[ndx]
+    self.min_ndx = min(self.min_ndx, other.min_ndx)
+    self.max_ndx = max(self.max_ndx, other.max_ndx)
+    # Combine means and squared deviations of the two sets (Chan et al.)
+    count = self.count + other.count
+    delta = other.mean_ns - self.mean_ns
+    self.mean_ns += delta * other.count / count
+    self.m2_ns += other.m2_ns + delta * delta * self.count * other.count / count
+    self.count = count
+    self.min_ns = other.min_ns if self.min_ns is None else min(self.min_ns, other.min_ns)
+    self.max_ns = other.max_ns if self.max_ns is None else max(self.max_ns, other.max_ns)
+
+  def copy(self):
+    result = LatencyHistogram()
+    result.merge(self)
+    return result
+
+  def percentiles_ns(self, percentiles=HISTOGRAM_PERCENTILES):
+    # Resolve all (ascending) percentiles in a single walk over the occupied buckets
+    if self.count == 0:
+      return [None for _ in percentiles]
+    results = []
+    counts = self.counts
+    ndx = self.min_ndx
+    cumulative = counts[ndx]
+    for percentile in percentiles:
+      target = max(1, math.ceil(self.count * percentile / 100))
+      while cumulative < target and ndx < self.max_ndx:
+        ndx += 1
+        cumulative += counts[ndx]
+      results.append(min(self.bucket_upper_bound_ns(ndx), self.max_ns))
+    return results
+
+  def format(self):
+    mean_ping = "n/a"
+    max_ping = "n/a"
+    min_ping = "n/a"
+    if self.count > 0:
+      mean_ping = f"{self.mean_ns / 1_000_000:.2f}"
+      max_ping = f"{self.max_ns / 1_000_000:.2f}"
+      min_ping = f"{self.min_ns / 1_000_000:.2f}"
+
+    stddev_ping = "n/a"
+    if self.count > 1:
+      stddev_ping = f"{math.sqrt(self.m2_ns / self.count) / 1_000_000:.1f}"
+
+    percentiles = " ".join(f"p{percentile:g}:{'n/a' if value_ns is None else f'{value_ns / 1_000_000:.2f}'}" for (percentile, value_ns) in zip(HISTOGRAM_PERCENTILES, self.percentiles_ns()))
+    return f"mean:{mean_ping} min:{min_ping} max:{max_ping} stddev:{stddev_ping} {percentiles}"
+
+# The tool counts as saturated when its own delays reach these, and its latency numbers can't be trusted.
+# The event loop timers have ~1ms resolution, so lags of that order are normal.
+SATURATION_LAG_NS = 5_000_000
+SATURATION_DROPPED = 0.01
+SATURATION_READER_BUSY = 0.5
+SATURATION_ANALYSIS_LAG_NS = 500_000_000
+
+class ToolOverhead:
+  """The probe's own timings during one reporting window, to tell its delays apart from the network's.
+  send_lag is how late each burst went out against the pacer schedule, loop_lag how much later than asked
+  the event loop woke the sender, and read_cost the reader's processing time per datagram (one sample per
+  wakeup). full_reads counts wakeups that hit MAX_DRAIN_DATAGRAMS with more replies queued."""
+  def __init__(self):
+    self.send_lag = LatencyHistogram()
+    self.loop_lag = LatencyHistogram()
+    self.read_cost = LatencyHistogram()
+    self.read_ns = 0
+    self.full_reads = 0
+    self.num_dropped = 0
+    self.num_windows = 0
+    self.max_analysis_lag_ns = 0
+    self.max_analysis_ns = 0
+
+  def clear(self):
+    self.send_lag.clear()
+    self.loop_lag.clear()
+    self.read_cost.clear()
+    self.read_ns = 0
+    self.full_reads = 0
+    self.num_dropped = 0
+    self.num_windows = 0
+    self.max_analysis_lag_ns = 0
+    self.max_analysis_ns = 0
+
+  def merge(self, other):
+    self.send_lag.merge(other.send_lag)
+    self.loop_lag.merge(other.loop_lag)
+    self.read_cost.merge(other.read_cost)
+    self.read_ns += other.read_ns
+    self.full_reads += other.full_reads
+    self.num_dropped += other.num_dropped
+    self.num_windows += other.num_windows
+    self.max_analysis_lag_ns = max(self.max_analysis_lag_ns, other.max_analysis_lag_ns)
+    self.max_analysis_ns = max(self.max_analysis_ns, other.max_analysis_ns)
+
+  def on_read(self, read_ns, num_datagrams, full):
+    if num_datagrams > 0:
+      self.read_cost.record(read_ns // num_datagrams)
+    self.read_ns += read_ns
+    if full:
+      self.full_reads += 1
+
+  def on_analyzed(self, analysis_lag_ns, analysis_ns):
+    self.num_windows += 1
+    self.max_analysis_lag_ns = max(self.max_analysis_lag_ns, analysis_lag_ns)
+    self.max_analysis_ns = max(self.max_analysis_ns, analysis_ns)
+
+  def reader_busy(self):
+    return self.read_ns / (self.num_windows * 1_000_000_000) if self.num_windows > 0 else 0.0
+
+  def saturation_reasons(self, num_sent):
+    reasons = []
+    if self.num_dropped > SATURATION_DROPPED * (num_sent + self.num_dropped):
+      reasons.append(f"pacer dropped {self.num_dropped} packets")
+    for (name, histogram) in (("send lag", self.send_lag), ("event loop lag", self.loop_lag)):
+      (p99_ns, ) = histogram.percentiles_ns((99.0, ))
+      if p99_ns is not None and p99_ns >= SATURATION_LAG_NS:
+        reasons.append(f"{name} p99 {p99_ns / 1_000_000:.2f}ms")
+    if self.reader_busy() >= SATURATION_READER_BUSY:
+      reasons.append(f"reader busy {100 * self.reader_busy():.0f}% of the time")
+    if self.full_reads > 0:
+      reasons.append(f"reader fell behind {self.full_reads} times")
+    if self.max_analysis_lag_ns >= SATURATION_ANALYSIS_LAG_NS:
+      reasons.append(f"analysis {self.max_analysis_lag_ns / 1_000_000:.0f}ms behind")
+    return reasons
+
+  def format(self):
+    (send_lag_ns, ) = self.send_lag.percentiles_ns((99.0, ))
+    (loop_lag_ns, ) = self.loop_lag.percentiles_ns((99.0, ))
+    (read_cost_ns, ) = self.read_cost.percentiles_ns((50.0, ))
+    send_lag = "n/a" if send_lag_ns is None else f"{send_lag_ns / 1_000_000:.2f}"
+    loop_lag = "n/a" if loop_lag_ns is None else f"{loop_lag_ns / 1_000_000:.2f}"
+    read_cost = "n/a" if read_cost_ns is None else f"{read_cost_ns / 1_000:.1f}"
+    return f"send lag p99:{send_lag} loop lag p99:{loop_lag} analysis lag:{self.max_analysis_lag_ns / 1_000_000:.1f} Reader(us/pkt) p50:{read_cost} busy:{100 * self.reader_busy():.0f}%"
+
+# Loss burst length histogram buckets, by powers of two
+LOSS_BURST_BUCKETS = ("1", "2", "3-4", "5-8", "9-16", "17-32", "33-64", "65+")
+
+class WindowStats:
+  """Statistics of the packets sent during one reporting window, or the whole run. Stats of separate
+  windows or probes are combined with merge(). rx_delay is the delay from the kernel receive timestamp
+  to the tool seeing the reply, only tracked with kernel timestamps. overhead holds the tool's own
+  timings of live runs."""
+  def __init__(self, track_rx_delay=False, track_overhead=False):
+    self.num_sent = 0
+    self.num_reorders = 0
+    self.max_reorder_dist = 0
+    self.jitter_ns = 0.0
+    self.loss_bursts = array("q", bytes(8 * len(LOSS_BURST_BUCKETS)))
+    self.max_loss_burst = 0
+    self.latency = LatencyHistogram()
+    self.reply_gap = LatencyHistogram()
+    self.rx_delay = LatencyHistogram() if track_rx_delay else None
+    self.overhead = ToolOverhead() if track_overhead else None
+
+  @property
+  def num_received(self):
+    return self.latency.count
+
+  @property
+  def num_lost(self):
+    return self.num_sent - self.num_received
+
+  @property
+  def num_loss_bursts(self):
+    return sum(self.loss_bursts)
+
+  def clear(self):
+    self.num_sent = 0
+    self.num_reorders = 0
+    self.max_reorder_dist = 0
+    self.jitter_ns = 0.0
+    for ndx in range(len(self.loss_bursts)):
+      self.loss_bursts[ndx] = 0
+    self.max_loss_burst = 0
+    self.latency.clear()
+    self.reply_gap.clear()
+    if self.rx_delay is not None:
+      self.rx_delay.clear()
+    if self.overhead is not None:
+      self.overhead.clear()
+
+  def merge(self, other):
+    self.num_sent += other.num_sent
+    self.num_reorders += other.num_reorders
+    self.max_reorder_dist = max(self.max_reorder_dist, other.max_reorder_dist)
+    # Jitter is a running estimate, merged stats report the worst one
+    self.jitter_ns = max(self.jitter_ns, other.jitter_ns)
+    for ndx in range(len(self.loss_bursts)):
+      self.loss_bursts[ndx] += other.loss_bursts[ndx]
+    self.max_loss_burst = max(self.max_loss_burst, other.max_loss_burst)
+    self.latency.merge(other.latency)
+    self.reply_gap.merge(other.reply_gap)
+    if other.rx_delay is not None:
+      if self.rx_delay is None:
+        self.rx_delay = LatencyHistogram()
+      self.rx_delay.merge(other.rx_delay)
+    if other.overhead is not None:
+      if self.overhead is None:
+        self.overhead = ToolOverhead()
+      self.overhead.merge(other.overhead)
+
+  def format_reply_gap(self):
+    (p50_ns, p99_ns) = self.reply_gap.percentiles_ns((50.0, 99.0))
+    if p50_ns is None:
+      return "Gap(ms) n/a"
+    return f"Gap(ms) p50:{p50_ns / 1_000_000:.2f} p99:{p99_ns / 1_000_000:.2f} max:{self.reply_gap.max_ns / 1_000_000:.2f}"
+
+  def format_loss_bursts(self):
+    return " ".join(f"{label}:{count}" for (label, count) in zip(LOSS_BURST_BUCKETS, self.loss_bursts))
+
+  def copy(self):
+    result = WindowStats()
+    result.merge(self)
+    return result
+
+  def format(self):
+    result = f"Sent {self.num_sent}, Lost {self.num_lost} (bursts {self.num_loss_bursts}, max {self.max_loss_burst}), Reorder {self.num_reorders} (max dist {self.max_reorder_dist}): Ping(ms) {self.latency.format()} Jitter(ms):{self.jitter_ns / 1_000_000:.2f} {self.format_reply_gap()}"
+    if self.rx_delay is not None:
+      result += f" RxDelay(ms) {self.rx_delay.format()}"
+    if self.overhead is not None:
+      result += f" Tool(ms) {self.overhead.format()}"
+    return result
+
+def format_timestamp(wall_clock_ns):
+  return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(wall_clock_ns // 1_000_000_000))
+
+def print_totals(total, report=print):
+  report(f"Total sent {total.num_sent}, total lost {total.num_lost}, total reorder {total.num_reorders} (max dist {total.max_reorder_dist})")
+  report(f"Total ping(ms) {total.latency.format()}")
+  report(f"Total loss bursts {total.num_loss_bursts} (max {total.max_loss_burst}), by length {total.format_loss_bursts()}")
+  report(f"Total reply gap(ms) {total.reply_gap.format()}, max jitter(ms) {total.jitter_ns / 1_000_000:.2f}")
+  if total.rx_delay is not None:
+    report(f"Total kernel to tool receive delay(ms) {total.rx_delay.format()}")
+  if total.overhead is not None:
+    overhead = total.overhead
+    report(f"Total tool send lag(ms) {overhead.send_lag.format()}")
+    report(f"Total tool event loop lag(ms) {overhead.loop_lag.format()}")
+    report(f"Total tool reader time per packet(ms) {overhead.read_cost.format()}, busy {100 * overhead.reader_busy():.1f}%, max analysis lag(ms) {overhead.max_analysis_lag_ns / 1_000_000:.1f} taking {overhead.max_analysis_ns / 1_000_000:.1f}")
+    reasons = overhead.saturation_reasons(total.num_sent)
+    if len(reasons) > 0:
+      report(f"WARNING: the tool itself was saturated ({', '.join(reasons)}), lower the rate or use -workers")
+
+class RangeAnalyzer:
+  """Analyzes consecutive ranges of sent packets in sequence number order, in a single pass over the ring
+  per range. Loss bursts, RFC 3550 interarrival jitter and the gaps between consecutive replies carry over
+  from one range to the next. A loss burst still open at the end of a range shows in its max_loss_burst,
+  and is counted as a burst when a reply ends it or on flush_loss_run()."""
+  def __init__(self, ring, record_latency=False):
+    self.ring = ring
+    # Live probes record latencies as replies arrive, offline analysis records them in the pass
+    self.record_latency = record_latency
+    self.next_seq = 0
+    self.loss_run = 0
+    self.jitter_ns = 0.0
+    self.prev_transit_ns = None
+    self.prev_recv_ns = None
+
+  def analyze_range(self, time_end, stats, max_packets=None):
+    # Count the packets sent before time_end into stats, at most max_packets of them per call. Returns
+    # whether the range is done. The latencies of their replies have already been recorded into stats
+    # as they arrived.
+    ring = self.ring
+    send_ns = ring.send_ns
+    recv_ns = ring.recv_ns
+    reorder_dist = ring.reorder_dist
+    mask = ring.mask
+    loss_bursts = stats.loss_bursts
+    reply_gap = stats.reply_gap
+    latency = stats.latency if self.record_latency else None
+    num_sent = 0
+    num_reorders = 0
+    max_reorder_dist = 0
+    loss_run = self.loss_run
+    jitter_ns = self.jitter_ns
+    prev_transit_ns = self.prev_transit_ns
+    prev_recv_ns = self.prev_recv_ns
+    seq = self.next_seq
+    end_seq = ring.num_sent if max_packets is None else min(ring.num_sent, seq + max_packets)
+    while seq < end_seq:
+      ndx = seq & mask
+      send_at = send_ns[ndx]
+      if send_at >= time_end:
+        break
+      seq += 1
+      num_sent += 1
+      reply_at = recv_ns[ndx]
+      if reply_at == 0:
+        loss_run += 1
+        continue
+      if loss_run > 0:
+        loss_bursts[min(len(loss_bursts) - 1, (loss_run - 1).bit_length())] += 1
+        stats.max_loss_burst = max(stats.max_loss_burst, loss_run)
+        loss_run = 0
+      # RFC 3550 section 6.4.1: J += (|D(i-1, i)| - J) / 16
+      transit_ns = reply_at - send_at
+      if latency is not None:
+        latency.record(transit_ns)
+      if prev_transit_ns is not None:
+        jitter_ns += (abs(transit_ns - prev_transit_ns) - jitter_ns) / 16
+        reply_gap.record(abs(reply_at - prev_recv_ns))
+      prev_transit_ns = transit_ns
+      prev_recv_ns = reply_at
+      if reorder_dist[ndx] > 0:
         num_reorders += 1
+        max_reorder_dist = max(max_reorder_dist, reorder_dist[ndx])
+
+    self.next_seq = seq
+    self.loss_run = loss_run
+    stats.max_loss_burst = max(stats.max_loss_burst, loss_run)
+    self.jitter_ns = jitter_ns
+    self.prev_transit_ns = prev_transit_ns
+    self.prev_recv_ns = prev_recv_ns
+    stats.num_sent += num_sent
+    stats.num_reorders += num_reorders
+    stats.max_reorder_dist = max(stats.max_reorder_dist, max_reorder_dist)
+    stats.jitter_ns = jitter_ns
+    return seq < end_seq or end_seq == ring.num_sent
+
+  def flush_loss_run(self, stats):
+    # Count the open loss burst into stats at the end of the run or analysis, eg, an outage that never recovered
+    if self.loss_run > 0:
+      stats.loss_bursts[min(len(stats.loss_bursts) - 1, (self.loss_run - 1).bit_length())] += 1
+      stats.max_loss_burst = max(stats.max_loss_burst, self.loss_run)
+      self.loss_run = 0
+
+# Capture file: a fixed size header followed by one fixed size record per packet in sequence number order
+CAPTURE_MAGIC = b"MPUDPCAP"
+CAPTURE_VERSION = 1
+CAPTURE_HEADER_FORMAT = struct.Struct("<8sIIIIIIqq80s") # magic, version, header size, record size, packet len, packet rate, reserved, start perf ns, start wall clock ns, label
+CAPTURE_RECORD_FORMAT = struct.Struct("<qqqII") # seq, send ns, receive ns (0 if lost), size, reorder distance
 
-  mean_ping = "n/a"
-  max_ping = "n/a"
-  min_ping = "n/a"
-  if len(ping_pong_in_range) > 0:
-    mean_ping_ms = sum(duration_ns / 1_000_000 for (_, _, _, duration_ns) in ping_pong_in_range ) / len(ping_pong_in_range)
-    mean_ping = f"{mean_ping_ms:.2f}"
-    max_ping_ms = max(duration_ns / 1_000_000 for (_, _, _, duration_ns) in ping_pong_in_range )
-    max_ping = f"{max_ping_ms:.2f}"
-    min_ping_ms = min(duration_ns / 1_000_000 for (_, _, _, duration_ns) in ping_pong_in_range )
-    min_ping = f"{min_ping_ms:.2f}"
-
-  stddev_ping = "n/a"
-  if len(ping_pong_in_range) > 1:
-    mean_ping_ns = sum(duration_ns for (_, _, _, duration_ns) in ping_pong_in_range ) / len(ping_pong_in_range)
-    std_dev_ping_ms = math.sqrt(sum(math.pow((duration_ns - mean_ping_ns) / 1_000_000, 2) for (_, _, _, duration_ns) in ping_pong_in_range ) / len(ping_pong_in_range))
-    stddev_ping = f"{std_dev_ping_ms:.1f}"
-
-  # cleanup
-  pings_to_clean = []
-  for id, ts in write_buf.items():
-    if ts < time_end:
-      pings_to_clean.append(id)
-  for id in pings_to_clean:
-    del write_buf[id]
-
-  pongs_to_clean = []
-  for id, ts in read_buf.items():
-    if ts < time_end:
-      pongs_to_clean.append(id)
-  for id in pongs_to_clean:
-    del read_buf[id]
-
-  return (num_sent, num_lost, mean_ping, min_ping, max_ping, stddev_ping, num_reorders)
-
-
-def test(ip, port, packet_len, packet_rate, test_limit):
-  s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+class CaptureWriter:
+  """Streams the per-packet records of each analyzed window to a capture file, through a reused buffer
+  and one buffered write per analyzed chunk of the window."""
+  def __init__(self, path, label, packet_len, packet_rate, start_ns, start_wall_clock_ns):
+    self.file = open(path, "wb", buffering=1024 * 1024)
+    self.packet_len = packet_len
+    self.buffer = bytearray()
+    self.file.write(CAPTURE_HEADER_FORMAT.pack(CAPTURE_MAGIC, CAPTURE_VERSION, CAPTURE_HEADER_FORMAT.size, CAPTURE_RECORD_FORMAT.size, packet_len, packet_rate, 0, start_ns, start_wall_clock_ns, label.encode("utf-8")[:80]))
+
+  def write_range(self, ring, first_seq, end_seq):
+    record_size = CAPTURE_RECORD_FORMAT.size
+    num_bytes = (end_seq - first_seq) * record_size
+    if len(self.buffer) < num_bytes:
+      self.buffer = bytearray(num_bytes)
+    buffer = self.buffer
+    pack_into = CAPTURE_RECORD_FORMAT.pack_into
+    (send_ns, recv_ns, reorder_dist, mask, packet_len) = (ring.send_ns, ring.recv_ns, ring.reorder_dist, ring.mask, self.packet_len)
+    offset = 0
+    for seq in range(first_seq, end_seq):
+      ndx = seq & mask
+      pack_into(buffer, offset, seq, send_ns[ndx], recv_ns[ndx], packet_len, reorder_dist[ndx])
+      offset += record_size
+    self.file.write(memoryview(buffer)[:num_bytes])
+    self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+class CaptureFile:
+  """Memory-maps a capture file and exposes its columns as zero-copy strided views, laid out like a
+  PacketRing indexed directly by sequence number so RangeAnalyzer can run over it."""
+  def __init__(self, path):
+    with open(path, "rb") as f:
+      self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(self.mmap) < CAPTURE_HEADER_FORMAT.size:
+      self.mmap.close()
+      raise ValueError(f"{path} is too short for a UDP test capture file header")
+    (magic, version, header_size, record_size, self.packet_len, self.packet_rate, _, self.start_ns, self.start_wall_clock_ns, label) = CAPTURE_HEADER_FORMAT.unpack_from(self.mmap)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION or record_size != CAPTURE_RECORD_FORMAT.size:
+      raise ValueError(f"{path} is not a version {CAPTURE_VERSION} UDP test capture file")
+    self.label = label.rstrip(b"\0").decode("utf-8")
+    num_records = (len(self.mmap) - header_size) // record_size
+    data = memoryview(self.mmap)[header_size:header_size + num_records * record_size]
+    # The views assume a little-endian host, like the records
+    int64s = data.cast("q")
+    uint32s = data.cast("I")
+    words = record_size // 8
+    self.send_ns = int64s[1::words]
+    self.recv_ns = int64s[2::words]
+    self.reorder_dist = uint32s[2 * words - 1::2 * words]
+    # PacketRing interface, indexed by record number
+    self.mask = -1
+    self.num_sent = num_records
+
+  def release(self):
+    for view in (self.send_ns, self.recv_ns, self.reorder_dist):
+      view.release()
+    self.mmap.close()
+
+def analyze_capture(path, window_seconds, from_seconds, to_seconds, report=print):
+  """Recomputes the per-window and total statistics of a capture file over [from_seconds, to_seconds) of
+  the run, in windows of window_seconds."""
+  capture = CaptureFile(path)
   try:
-    reply = ask_raw(s, "pinghelo".encode("utf-8"), ip, port)
-    if reply.decode("utf-8") != "ponghelo":
-      print(f"Unexpected hello reply from UDP test server at {ip}:{port}")
-      sys.exit(3)
-  except socket.timeout:
-    print(f"Could not connect to the UDP test server at {ip}:{port}")
-    sys.exit(2)
-  print(f"Connected to the UDP test server at {ip}:{port}. Performing test.")
-  print(f" Packet rate: {packet_rate} packets/s")
-  print(f" Packet size: {packet_len} B")
-  print(f" Expected bandwidth: {bandwidth_str(packet_rate * packet_len)}")
-  print()
+    report(f"Capture of {capture.label}, started {format_timestamp(capture.start_wall_clock_ns)}: {capture.num_sent} packets of {capture.packet_len} B at {capture.packet_rate} packets/s")
+    window_ns = int(window_seconds * 1_000_000_000)
+    time_start = capture.start_ns + int(from_seconds * 1_000_000_000)
+    time_limit = None if to_seconds is None else capture.start_ns + int(to_seconds * 1_000_000_000)
+    analyzer = RangeAnalyzer(capture, record_latency=True)
+    analyzer.next_seq = bisect.bisect_left(capture.send_ns, time_start)
+    stats = WindowStats()
+    total = WindowStats()
+    window_end = time_start + window_ns
+    while analyzer.next_seq < capture.num_sent and (time_limit is None or window_end - window_ns < time_limit):
+      analyzer.analyze_range(window_end if time_limit is None else min(window_end, time_limit), stats)
+      report(f"[{format_timestamp(capture.start_wall_clock_ns + window_end - capture.start_ns)}] ({capture.label}): {stats.format()}")
+      total.merge(stats)
+      stats.clear()
+      window_end += window_ns
+    analyzer.flush_loss_run(total)
+    print_totals(total, report)
+  finally:
+    capture.release()
 
-  s.settimeout(None)
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+MAX_DRAIN_DATAGRAMS = 256
+# Windows are analyzed 3 seconds after they start, keep stats for a few more in case the analysis lags
+NUM_WINDOW_STATS = 6
+# Packets to analyze between yields to the event loop, so the reader isn't held up for long at high rates
+ANALYSIS_CHUNK_PACKETS = 2048
+# Linux kernel receive timestamps (struct timespec of CLOCK_REALTIME), not exposed by the socket module
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+TIMESPEC_FORMAT = struct.Struct("@ll")
 
-  read_buf = {}
-  read_buf_lock = threading.Lock()
+def default_max_burst(packet_rate):
+  # Max packets to send back-to-back when catching up with the schedule: 2ms worth of packets, at least 8
+  return max(8, packet_rate // 500)
 
-  def reader():
-    pong_bytes = "pong".encode("utf-8")
-    while True:
-      (reply, addr) = s.recvfrom(4096)
-      reply_at = time.perf_counter_ns()
-      if len(reply) != packet_len or reply[0:4] != pong_bytes:
-        print("invalid response")
-      (reply_ndx, ) = struct.unpack_from("=l", reply, 4)
-      read_buf_lock.acquire()
-      read_buf[reply_ndx] = reply_at
-      read_buf_lock.release()
-
-  write_buf = {}
-  write_buf_lock = threading.Lock()
-  start_at = time.perf_counter_ns()
-  start_at_wall_clock = time.time_ns()
-
-  def writer():
-    num_messages_sent = 0
-    ns_per_packet = 1_000_000_000 / packet_rate
-    buffer = bytearray(packet_len)
-    buffer[0:4] = "ping".encode("utf-8")
+class UnexpectedReplyError(Exception):
+  pass
+
+class ProbeProtocol(asyncio.DatagramProtocol):
+  def __init__(self, probe):
+    self.probe = probe
+
+  def datagram_received(self, data, addr):
+    read_at = time.perf_counter_ns()
+    self.probe.on_datagram(data, read_at)
+    num_drained = self.probe.drain_socket()
+    self.probe.on_read(read_at, 1 + num_drained, num_drained == MAX_DRAIN_DATAGRAMS)
+
+  def error_received(self, exc):
+    # ICMP errors (eg, port unreachable) show up as lost packets
+    pass
+
+class UdpProbe:
+  """Probes the network quality to one UDP test server: sends paced pings, records the pongs and
+  analyzes each second once all its replies should have arrived. Everything runs in a single event
+  loop; use run() as a coroutine, it stops after test_limit seconds or when cancelled. The tool's own
+  overhead costs three histograms per window, probes that share an event loop only need one to track it."""
+  def __init__(self, ip, port, packet_len, packet_rate, max_burst, report=print, label=None, on_window=None, kernel_timestamps=False, max_packet_rate=None, capture_path=None, track_overhead=True):
+    self.ip = ip
+    self.port = port
+    self.label = label if label is not None else f"{ip}:{port}"
+    self.packet_len = packet_len
+    self.packet_rate = packet_rate
+    self.max_burst = max_burst
+    self.kernel_timestamps = kernel_timestamps
+    self.capture_path = capture_path
+    self.report = report
+    # Called with (second, window end wall clock ns, WindowStats) instead of printing the window.
+    # The stats are recycled afterwards, use WindowStats.copy() to keep them.
+    self.on_window = on_window
+    # Room for the packets of the analysis delay (~3s) with plenty of margin, at the highest rate set_rate() will use
+    self.ring = PacketRing(max(packet_rate, max_packet_rate or 0) * 8)
+    self.arrivals = ArrivalTracker()
+    self.seq_format = struct.Struct("=l")
+    self.sock = None
+    self.transport = None
+    self.hello_reply = None
+    self.recv_buffer = bytearray(4096)
+    self.ancillary_size = 0
+    self.timestamp_sock = None
+    self.pacer = None
+    self.start_at = None
+    self.analyzer = None
+    self.analyzed_second = 0
+    self.window_stats = [WindowStats(kernel_timestamps, track_overhead) for _ in range(NUM_WINDOW_STATS)]
+    self.total = WindowStats(kernel_timestamps, track_overhead)
+
+  def window_overhead(self, now_ns):
+    # The overhead stats of the window in progress at now_ns, if still held
+    if self.start_at is None:
+      return None
+    second = (now_ns - self.start_at) // 1_000_000_000
+    if self.analyzed_second <= second < self.analyzed_second + NUM_WINDOW_STATS:
+      return self.window_stats[second % NUM_WINDOW_STATS].overhead
+    return None
+
+  def on_read(self, read_at, num_datagrams, full):
+    now = time.perf_counter_ns()
+    overhead = self.window_overhead(now)
+    if overhead is not None:
+      overhead.on_read(now - read_at, num_datagrams, full)
+
+  def on_datagram(self, reply, reply_at, user_at=None):
+    if self.hello_reply is not None and not self.hello_reply.done():
+      self.hello_reply.set_result(bytes(reply))
+      return
+    if len(reply) != self.packet_len or reply[0:4] != b"pong":
+      self.report("invalid response")
+      return
+    (reply_ndx, ) = self.seq_format.unpack_from(reply, 4)
+    reorder_dist = self.arrivals.on_arrival(reply_ndx)
+    if reply_ndx < self.analyzer.next_seq:
+      return # already counted as lost by the analysis in progress
+    if self.ring.on_receive(reply_ndx, reply_at, reorder_dist):
+      # Record the latency into the histogram of the window the ping was sent in, unless already analyzed
+      send_at = self.ring.send_ns[reply_ndx & self.ring.mask]
+      second = (send_at - self.start_at) // 1_000_000_000
+      if self.analyzed_second <= second < self.analyzed_second + NUM_WINDOW_STATS:
+        stats = self.window_stats[second % NUM_WINDOW_STATS]
+        stats.latency.record(reply_at - send_at)
+        if user_at is not None:
+          stats.rx_delay.record(user_at - reply_at)
+
+  def drain_socket(self):
+    # The transport delivers one datagram per event loop iteration, read the rest of the burst directly.
+    # Returns the number of datagrams read.
+    buffer = self.recv_buffer
+    view = memoryview(buffer)
+    for ndx in range(MAX_DRAIN_DATAGRAMS):
+      try:
+        reply_len = self.sock.recv_into(buffer)
+      except (BlockingIOError, InterruptedError):
+        return ndx
+      except OSError:
+        return ndx # eg, ICMP port unreachable, the transport reports it on its next read
+      self.on_datagram(view[:reply_len], time.perf_counter_ns())
+    return MAX_DRAIN_DATAGRAMS
+
+  def drain_socket_timestamped(self):
+    # Replaces the transport's reader with kernel timestamps: reads every datagram with recvmsg to get the
+    # kernel receive timestamp, converted from CLOCK_REALTIME to perf_counter_ns
+    read_at = time.perf_counter_ns()
+    clock_offset = time.time_ns() - read_at
+    buffers = [self.recv_buffer]
+    view = memoryview(self.recv_buffer)
+    num_read = 0
+    full = True
+    for _ in range(MAX_DRAIN_DATAGRAMS):
+      try:
+        (reply_len, ancdata, _, _) = self.timestamp_sock.recvmsg_into(buffers, self.ancillary_size)
+      except (BlockingIOError, InterruptedError):
+        full = False
+        break
+      except OSError:
+        continue # eg, ICMP port unreachable
+      num_read += 1
+      user_at = time.perf_counter_ns()
+      reply_at = user_at
+      for (level, kind, data) in ancdata:
+        if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(data) >= TIMESPEC_FORMAT.size:
+          (sec, nsec) = TIMESPEC_FORMAT.unpack_from(data)
+          reply_at = min(user_at, sec * 1_000_000_000 + nsec - clock_offset)
+      self.on_datagram(view[:reply_len], reply_at, user_at)
+    self.on_read(read_at, num_read, full)
+
+  async def connect(self):
+    loop = asyncio.get_running_loop()
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.setblocking(False)
+    # Large receive buffer absorbs reply bursts while the event loop is busy sending or analyzing
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+    self.sock.connect((self.ip, self.port))
+    if self.kernel_timestamps:
+      self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+      self.ancillary_size = socket.CMSG_SPACE(TIMESPEC_FORMAT.size)
+    (self.transport, _) = await loop.create_datagram_endpoint(lambda: ProbeProtocol(self), sock=self.sock)
+    if self.kernel_timestamps:
+      # Take over reading from the transport, through a duplicate of the socket as the event loop only allows
+      # one owner per file descriptor
+      self.transport.pause_reading()
+      self.timestamp_sock = self.sock.dup()
+      loop.add_reader(self.timestamp_sock.fileno(), self.drain_socket_timestamped)
+    self.hello_reply = loop.create_future()
+    try:
+      self.transport.sendto(b"pinghelo")
+      reply = await asyncio.wait_for(self.hello_reply, timeout=5)
+      if reply != b"ponghelo":
+        raise UnexpectedReplyError(f"Unexpected hello reply from UDP test server at {self.ip}:{self.port}")
+    except:
+      self.close()
+      raise
+
+  def close(self):
+    if self.timestamp_sock is not None:
+      asyncio.get_running_loop().remove_reader(self.timestamp_sock.fileno())
+      self.timestamp_sock.close()
+      self.timestamp_sock = None
+    if self.transport is not None:
+      self.transport.close()
+      self.transport = None
+    elif self.sock is not None:
+      self.sock.close()
+    self.sock = None
+
+  def set_rate(self, packet_rate, max_burst):
+    # Change the send rate of a running probe, the ring must have been sized for it with max_packet_rate
+    self.packet_rate = packet_rate
+    self.max_burst = max_burst
+    if self.pacer is not None:
+      self.pacer.set_rate(packet_rate, max_burst, time.perf_counter_ns())
+
+  def current_second(self):
+    return (time.perf_counter_ns() - self.start_at) // 1_000_000_000
+
+  async def _send(self, start_at):
+    self.pacer = Pacer(self.packet_rate, self.max_burst, start_at)
+    pacer = self.pacer
+    buffer = bytearray(self.packet_len)
+    buffer[0:4] = b"ping"
+    num_dropped = 0
     while True:
-      struct.pack_into("=l", buffer, 4, num_messages_sent)
-      next_send_time = start_at + num_messages_sent * ns_per_packet
-      send_time = time.perf_counter_ns()
-      if send_time >= next_send_time:
-        s.sendto(buffer, (ip, port))
-        write_buf_lock.acquire()
-        write_buf[num_messages_sent] = send_time
-        write_buf_lock.release()
-        num_messages_sent += 1
+      now = time.perf_counter_ns()
+      scheduled_at = pacer.next_send_ns
+      num_due = pacer.num_due(now)
+      if num_due == 0:
+        sleep_ns = pacer.sleep_ns(now)
+        await asyncio.sleep(sleep_ns / 1_000_000_000)
+        slept_ns = time.perf_counter_ns() - now
+        pacer.on_slept(sleep_ns, slept_ns)
+        overhead = self.window_overhead(now + slept_ns)
+        if overhead is not None:
+          overhead.loop_lag.record(max(0, int(slept_ns - sleep_ns)))
+        continue
+      overhead = self.window_overhead(now)
+      if overhead is not None:
+        overhead.send_lag.record(now - int(scheduled_at))
+        overhead.num_dropped += pacer.num_dropped - num_dropped
+      num_dropped = pacer.num_dropped
+      seq = pacer.num_sent
+      for _ in range(num_due):
+        self.seq_format.pack_into(buffer, 4, seq)
+        self.ring.on_send(seq, time.perf_counter_ns())
+        self.transport.sendto(buffer)
+        seq += 1
+      pacer.on_sent(num_due)
+
+  async def run(self, test_limit=None):
+    if self.transport is None:
+      await self.connect()
+    start_at = time.perf_counter_ns()
+    start_at_wall_clock = time.time_ns()
+    self.start_at = start_at
+    self.analyzer = RangeAnalyzer(self.ring)
+    analyzer = self.analyzer
+    sender = asyncio.create_task(self._send(start_at))
+    capture = None
+    if self.capture_path is not None:
+      capture = CaptureWriter(self.capture_path, self.label, self.packet_len, self.packet_rate, start_at, start_at_wall_clock)
+    try:
+      while test_limit is None or self.analyzed_second < test_limit:
+        # Current second is in progress, previous might complete now. 2 seconds ago is valid
+        analyze_at = start_at + (self.analyzed_second + 3) * 1_000_000_000
+        await asyncio.sleep(max(0, analyze_at - time.perf_counter_ns()) / 1_000_000_000)
+        if sender.done():
+          sender.result() # propagate send errors
+
+        # Analyze the window in chunks and let the reader and sender run in between
+        analysis_lag = max(0, time.perf_counter_ns() - analyze_at)
+        analysis_ns = 0
+        analyze_end = start_at + (self.analyzed_second + 1) * 1_000_000_000
+        stats = self.window_stats[self.analyzed_second % NUM_WINDOW_STATS]
+        while True:
+          chunk_start = time.perf_counter_ns()
+          first_seq = analyzer.next_seq
+          done = analyzer.analyze_range(analyze_end, stats, ANALYSIS_CHUNK_PACKETS)
+          if capture is not None:
+            capture.write_range(self.ring, first_seq, analyzer.next_seq)
+          analysis_ns += time.perf_counter_ns() - chunk_start
+          if done:
+            break
+          await asyncio.sleep(0)
+        if stats.overhead is not None:
+          stats.overhead.on_analyzed(analysis_lag, analysis_ns)
+
+        analyze_end_wall_clock = start_at_wall_clock + (self.analyzed_second + 1) * 1_000_000_000
+        if self.on_window is not None:
+          self.on_window(self.analyzed_second, analyze_end_wall_clock, stats)
+        else:
+          self.report(f"[{format_timestamp(analyze_end_wall_clock)}] ({self.label}): {stats.format()}")
+        reasons = [] if stats.overhead is None else stats.overhead.saturation_reasons(stats.num_sent)
+        if len(reasons) > 0:
+          self.report(f"[{format_timestamp(analyze_end_wall_clock)}] ({self.label}): WARNING: tool saturated ({', '.join(reasons)}), the numbers above include its own delays")
+
+        self.total.merge(stats)
+        stats.clear()
+        self.analyzed_second += 1
+    finally:
+      analyzer.flush_loss_run(self.total)
+      sender.cancel()
+      try:
+        await sender
+      except asyncio.CancelledError:
+        pass
+      self.close()
+      if capture is not None:
+        capture.close()
+
+  def print_summary(self):
+    print_totals(self.total, self.report)
+    if self.analyzed_second > 0:
+      achieved_rate = self.total.num_sent / self.analyzed_second
+      self.report(f"Send rate achieved {achieved_rate:.0f} packets/s of requested {self.packet_rate} ({100 * achieved_rate / self.packet_rate:.1f}%), {bandwidth_str(int(achieved_rate * self.packet_len))}")
+    if self.pacer is not None and self.pacer.num_bursts > 0:
+      self.report(f"Sent in {self.pacer.num_bursts} bursts (avg {self.pacer.num_sent / self.pacer.num_bursts:.1f} packets), {self.pacer.num_dropped} packets dropped by pacer falling behind")
+
+async def probe(ip, port, packet_len, packet_rate, test_limit, max_burst, report=print, kernel_timestamps=False):
+  """Connects to the UDP test server and runs the test, returns the UdpProbe with the totals."""
+  udp_probe = UdpProbe(ip, port, packet_len, packet_rate, max_burst, report, kernel_timestamps=kernel_timestamps)
+  await udp_probe.run(test_limit)
+  return udp_probe
+
+async def connect_all(probes, report=print):
+  """Connects all probes concurrently, returns the ones that connected."""
+  results = await asyncio.gather(*[udp_probe.connect() for udp_probe in probes], return_exceptions=True)
+  connected = []
+  for (udp_probe, result) in zip(probes, results):
+    if isinstance(result, asyncio.TimeoutError):
+      report(f"Could not connect to the UDP test server at {udp_probe.label}")
+    elif isinstance(result, BaseException):
+      report(f"Failed to connect to the UDP test server at {udp_probe.label}: {result}")
+    else:
+      connected.append(udp_probe)
+  return connected
+
+async def probe_fleet(targets, packet_len, packet_rate, test_limit, max_burst, report=print, kernel_timestamps=False):
+  """Probes all (label, ip, port) targets at the same time from this event loop, each with its own
+  socket, sequence space and statistics. The first probe tracks the overhead of the shared event loop.
+  Returns the UdpProbes that connected."""
+  probes = await connect_all([UdpProbe(ip, port, packet_len, packet_rate, max_burst, report, label, kernel_timestamps=kernel_timestamps, track_overhead=(ndx == 0)) for (ndx, (label, ip, port)) in enumerate(targets)], report)
+  await asyncio.gather(*[udp_probe.run(test_limit) for udp_probe in probes])
+  return probes
+
+def test(ip, port, packet_len, packet_rate, test_limit, max_burst, kernel_timestamps, capture_path):
+  udp_probe = UdpProbe(ip, port, packet_len, packet_rate, max_burst, kernel_timestamps=kernel_timestamps, capture_path=capture_path)
+
+  async def run():
+    try:
+      await udp_probe.connect()
+    except asyncio.TimeoutError:
+      print(f"Could not connect to the UDP test server at {ip}:{port}")
+      sys.exit(2)
+    except UnexpectedReplyError as ex:
+      print(ex)
+      sys.exit(3)
+    print(f"Connected to the UDP test server at {ip}:{port}. Performing test.")
+    print(f" Packet rate: {packet_rate} packets/s")
+    print(f" Packet size: {packet_len} B")
+    print(f" Expected bandwidth: {bandwidth_str(packet_rate * packet_len)}")
+    print(f" Max burst: {max_burst} packets")
+    print()
+    await udp_probe.run(test_limit)
+
+  try:
+    asyncio.run(run())
+  except KeyboardInterrupt:
+    pass
+
+  udp_probe.print_summary()
+
+class CapacitySweep:
+  """Finds the highest packet rate a UDP test server sustains, using a single running probe. The rate is
+  doubled (or raised by a fixed step) until a level breaks the loss or p99 latency limit, then binary
+  searched between the last good and the first bad level. Each level is held for settle_seconds before
+  hold_seconds of windows are measured."""
+  def __init__(self, udp_probe, start_rate, max_rate, step, hold_seconds, settle_seconds, max_loss_percent, max_p99_ms, burst_for_rate, report=print):
+    self.probe = udp_probe
+    self.start_rate = start_rate
+    self.max_rate = max_rate
+    self.step = step
+    self.hold_seconds = hold_seconds
+    self.settle_seconds = settle_seconds
+    self.max_loss_percent = max_loss_percent
+    self.max_p99_ms = max_p99_ms
+    self.burst_for_rate = burst_for_rate
+    self.report = report
+    self.curve = [] # (rate, achieved rate, WindowStats, verdict)
+    self.level_first_second = None
+    self.level_stats = None
+    self.level_num_windows = 0
+    self.level_done = asyncio.Event()
+    udp_probe.on_window = self.on_window
+
+  def on_window(self, second, end_wall_clock, stats):
+    self.report(f"[{format_timestamp(end_wall_clock)}] ({self.probe.label} @ {self.probe.packet_rate}/s): {stats.format()}")
+    if self.level_first_second is None or second < self.level_first_second or self.level_done.is_set():
+      return
+    self.level_stats.merge(stats)
+    self.level_num_windows += 1
+    if self.level_num_windows >= self.hold_seconds:
+      self.level_done.set()
+
+  async def measure(self, rate):
+    self.probe.set_rate(rate, self.burst_for_rate(rate))
+    # Skip the window in progress and the settle time
+    self.level_first_second = self.probe.current_second() + 1 + self.settle_seconds
+    self.level_stats = WindowStats()
+    self.level_num_windows = 0
+    self.level_done.clear()
+    await self.level_done.wait()
+
+    stats = self.level_stats
+    achieved_rate = stats.num_sent / self.hold_seconds
+    loss_percent = 100 * stats.num_lost / stats.num_sent if stats.num_sent > 0 else 100.0
+    (p99_ns, ) = stats.latency.percentiles_ns((99.0, ))
+    if achieved_rate < 0.95 * rate:
+      verdict = "tool-limited"
+    elif loss_percent > self.max_loss_percent:
+      verdict = "loss"
+    elif p99_ns is None or p99_ns / 1_000_000 > self.max_p99_ms:
+      verdict = "latency"
+    else:
+      verdict = "ok"
+    self.curve.append((rate, achieved_rate, stats, verdict))
+    self.report(f"Sweep level {rate} packets/s: achieved {achieved_rate:.0f} packets/s, loss {loss_percent:.2f}%, p99 {'n/a' if p99_ns is None else f'{p99_ns / 1_000_000:.2f}'}ms -> {verdict}")
+    return verdict
+
+  async def search(self):
+    # Returns the highest rate that passed, or None
+    best = None
+    rate = self.start_rate
+    failed = None
+    while rate <= self.max_rate:
+      verdict = await self.measure(rate)
+      if verdict != "ok":
+        failed = rate
+        break
+      best = rate
+      if rate == self.max_rate:
+        break
+      rate = min(self.max_rate, rate + self.step if self.step is not None else rate * 2)
+    if failed is None or self.curve[-1][3] == "tool-limited":
+      return best
+    # Binary search down to 5% resolution between the last good and the first bad level
+    low = best if best is not None else 0
+    high = failed
+    while high - low > max(1, low // 20):
+      rate = (low + high) // 2
+      if rate <= 0:
+        break
+      verdict = await self.measure(rate)
+      if verdict == "ok":
+        low = rate
+        best = rate
+      elif verdict == "tool-limited":
+        break
       else:
-        time.sleep(0.0001)
+        high = rate
+    return best
 
-  reader_thread = threading.Thread(target=reader)
-  reader_thread.deamon=True
-  reader_thread.start()
+  async def run(self):
+    await self.probe.connect()
+    runner = asyncio.create_task(self.probe.run())
+    await asyncio.sleep(0) # let run() start the clock
+    try:
+      search = asyncio.create_task(self.search())
+      await asyncio.wait([runner, search], return_when=asyncio.FIRST_COMPLETED)
+      if runner.done():
+        search.cancel()
+        runner.result() # propagate probe errors
+      return search.result()
+    finally:
+      runner.cancel()
+      try:
+        await runner
+      except asyncio.CancelledError:
+        pass
 
-  writer_thread = threading.Thread(target=writer)
-  writer_thread.deamon=True
-  writer_thread.start()
+  def print_curve(self, best):
+    self.report("")
+    self.report("Capacity curve:")
+    for (rate, achieved_rate, stats, verdict) in sorted(self.curve, key=lambda level: level[0]):
+      self.report(f" {rate:>8} packets/s ({bandwidth_str(rate * self.probe.packet_len)}): achieved {achieved_rate:.0f}, {stats.format()} -> {verdict}")
+    if best is None:
+      self.report("No sustainable rate found")
+    else:
+      self.report(f"Max sustainable rate: {best} packets/s, {bandwidth_str(best * self.probe.packet_len)}")
+    limited = [rate for (rate, _, _, verdict) in self.curve if verdict == "tool-limited"]
+    if len(limited) > 0:
+      self.report(f"Warning: the tool could not send at {min(limited)} packets/s, the server may sustain more (try -workers)")
 
-  analyzed_second = 0
-  write_buf_copy = {}
-  read_buf_copy = {}
-  total_num_lost = 0
-  total_num_sent = 0
-  total_num_reorders = 0
+def test_sweep(ip, port, packet_len, packet_rate, max_rate, step, hold_seconds, settle_seconds, max_loss_percent, max_p99_ms, burst_for_rate, kernel_timestamps, capture_path):
+  udp_probe = UdpProbe(ip, port, packet_len, packet_rate, burst_for_rate(packet_rate), kernel_timestamps=kernel_timestamps, max_packet_rate=max_rate, capture_path=capture_path)
+  sweep = CapacitySweep(udp_probe, packet_rate, max_rate, step, hold_seconds, settle_seconds, max_loss_percent, max_p99_ms, burst_for_rate)
+  print(f"Sweeping the UDP test server at {ip}:{port} from {packet_rate} to {max_rate} packets/s.")
+  print(f" Packet size: {packet_len} B")
+  print(f" Limits: loss {max_loss_percent}%, p99 {max_p99_ms}ms, each level held {hold_seconds}s after {settle_seconds}s settle")
+  print()
 
+  best = None
   try:
-    while True:
-      time.sleep(0.1)
-      current_second = (time.perf_counter_ns() - start_at) // 1_000_000_000
-      complete_second = current_second - 2 # Current second is in progress, previous might complete now. 2 seconds ago is valid
-      if complete_second <= analyzed_second:
-        continue
+    best = asyncio.run(sweep.run())
+  except asyncio.TimeoutError:
+    print(f"Could not connect to the UDP test server at {ip}:{port}")
+    sys.exit(2)
+  except UnexpectedReplyError as ex:
+    print(ex)
+    sys.exit(3)
+  except KeyboardInterrupt:
+    pass
+  sweep.print_curve(best)
 
-      read_buf_lock.acquire()
-      read_buf_copy.update(read_buf)
-      read_buf = {}
-      read_buf_lock.release()
+def run_worker(worker_ndx, ip, port, packet_len, packet_rate, test_limit, max_burst, kernel_timestamps, capture_path, results):
+  # Entrypoint of a -workers process: runs one probe with its own socket and streams its per-second
+  # stats and final totals to the parent through the results queue
+  udp_probe = UdpProbe(ip, port, packet_len, packet_rate, max_burst,
+    report=lambda line: results.put(("log", worker_ndx, line)),
+    on_window=lambda second, end_wall_clock, stats: results.put(("window", worker_ndx, second, end_wall_clock, stats.copy())),
+    kernel_timestamps=kernel_timestamps,
+    capture_path=None if capture_path is None else f"{capture_path}.{worker_ndx}")
 
-      write_buf_lock.acquire()
-      write_buf_copy.update(write_buf)
-      write_buf = {}
-      write_buf_lock.release()
+  async def run():
+    try:
+      await udp_probe.connect()
+    except asyncio.TimeoutError:
+      results.put(("log", worker_ndx, f"Could not connect to the UDP test server at {ip}:{port}"))
+      return
+    except UnexpectedReplyError as ex:
+      results.put(("log", worker_ndx, str(ex)))
+      return
+    results.put(("connected", worker_ndx, udp_probe.sock.getsockname()[1]))
+    await udp_probe.run(test_limit)
 
-      analyze_start = start_at + analyzed_second * 1_000_000_000
-      analyze_end = start_at + (analyzed_second + 1) * 1_000_000_000
-      (num_sent, num_lost, mean_ping, min_ping, max_ping, stddev_ping, num_reorders) = analyze_range(write_buf_copy, read_buf_copy, analyze_start, analyze_end)
+  try:
+    asyncio.run(run())
+  except KeyboardInterrupt:
+    pass
+  finally:
+    pacer = udp_probe.pacer
+    results.put(("done", worker_ndx, udp_probe.total, udp_probe.analyzed_second, pacer.num_bursts if pacer else 0, pacer.num_dropped if pacer else 0))
 
-      analyze_end_wall_clock = start_at_wall_clock + (analyzed_second + 1) * 1_000_000_000
-      ts = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(analyze_end_wall_clock // 1_000_000_000))
-      print(f"[{ts}] ({ip}:{port}): Sent {num_sent}, Lost {num_lost}, Reorder {num_reorders}: Ping(ms) mean:{mean_ping} min:{min_ping} max:{max_ping} stddev:{stddev_ping}")
+def test_workers(ip, port, packet_len, packet_rate, test_limit, max_burst, kernel_timestamps, capture_path, num_workers):
+  print(f"Starting {num_workers} worker processes against the UDP test server at {ip}:{port}.")
+  print(f" Packet rate: {packet_rate} packets/s per worker, {packet_rate * num_workers} packets/s total")
+  print(f" Packet size: {packet_len} B")
+  print(f" Expected bandwidth: {bandwidth_str(packet_rate * packet_len * num_workers)}")
+  print(f" Max burst: {max_burst} packets")
+  print()
 
-      total_num_sent += num_sent
-      total_num_lost += num_lost
-      total_num_reorders += num_reorders
+  context = multiprocessing.get_context()
+  results = context.Queue()
+  workers = [context.Process(target=run_worker, args=(ndx, ip, port, packet_len, packet_rate, test_limit, max_burst, kernel_timestamps, capture_path, results), daemon=True) for ndx in range(num_workers)]
+  for worker in workers:
+    worker.start()
 
-      analyzed_second += 1
-      if test_limit is not None and analyzed_second >= test_limit:
+  active = set(range(num_workers))
+  windows = {} # second -> (end wall clock, {worker_ndx: WindowStats})
+  finals = {} # worker_ndx -> (total, analyzed_seconds, num_bursts, num_dropped)
+
+  def flush_windows():
+    # Report each second once every worker still running has delivered it
+    for second in sorted(windows):
+      (end_wall_clock, per_worker) = windows[second]
+      if not active.issubset(per_worker):
         break
+      del windows[second]
+      merged = WindowStats()
+      for stats in per_worker.values():
+        merged.merge(stats)
+      print(f"[{format_timestamp(end_wall_clock)}] ({ip}:{port} x{len(per_worker)}): {merged.format()}")
+      for worker_ndx in sorted(per_worker):
+        print(f"  worker {worker_ndx}: {per_worker[worker_ndx].format()}")
+
+  def handle(message):
+    kind = message[0]
+    worker_ndx = message[1]
+    if kind == "log":
+      print(f"[worker {worker_ndx}] {message[2]}")
+    elif kind == "connected":
+      print(f"[worker {worker_ndx}] Connected from local port {message[2]}")
+    elif kind == "window":
+      (_, _, second, end_wall_clock, stats) = message
+      (prev_end_wall_clock, per_worker) = windows.setdefault(second, (end_wall_clock, {}))
+      per_worker[worker_ndx] = stats
+      windows[second] = (max(prev_end_wall_clock, end_wall_clock), per_worker)
+    elif kind == "done":
+      finals[worker_ndx] = message[2:]
+      active.discard(worker_ndx)
+    flush_windows()
+
+  try:
+    while len(active) > 0:
+      handle(results.get())
+  except KeyboardInterrupt:
+    # The workers got the interrupt too, collect their totals
+    try:
+      while len(active) > 0:
+        handle(results.get(timeout=5))
+    except (queue.Empty, KeyboardInterrupt):
+      pass
+
+  for worker in workers:
+    worker.join(timeout=1)
+    if worker.is_alive():
+      worker.terminate()
+
+  total = WindowStats()
+  total_achieved_rate = 0.0
+  print()
+  for worker_ndx in sorted(finals):
+    (worker_total, analyzed_seconds, num_bursts, num_dropped) = finals[worker_ndx]
+    total.merge(worker_total)
+    achieved_rate = worker_total.num_sent / analyzed_seconds if analyzed_seconds > 0 else 0.0
+    total_achieved_rate += achieved_rate
+    print(f"worker {worker_ndx}: {worker_total.format()}, achieved {achieved_rate:.0f} packets/s, {num_bursts} bursts, {num_dropped} packets dropped by pacer")
+  print_totals(total)
+  print(f"Send rate achieved {total_achieved_rate:.0f} packets/s of requested {packet_rate * num_workers} ({100 * total_achieved_rate / (packet_rate * num_workers):.1f}%), {bandwidth_str(int(total_achieved_rate * packet_len))}")
 
+def test_fleet(targets, packet_len, packet_rate, test_limit, max_burst, kernel_timestamps, capture_path):
+  # The probes share one event loop, so the first one's overhead stats tell whether the tool saturates
+  probes = [UdpProbe(ip, port, packet_len, packet_rate, max_burst, label=label, kernel_timestamps=kernel_timestamps, capture_path=None if capture_path is None else f"{capture_path}.{ndx}", track_overhead=(ndx == 0)) for (ndx, (label, ip, port)) in enumerate(targets)]
+  connected = []
+
+  async def run():
+    connected.extend(await connect_all(probes))
+    if len(connected) == 0:
+      sys.exit(2)
+    print(f"Connected to {len(connected)}/{len(probes)} UDP test servers. Performing test.")
+    print(f" Packet rate: {packet_rate} packets/s per target")
+    print(f" Packet size: {packet_len} B")
+    print(f" Expected bandwidth: {bandwidth_str(packet_rate * packet_len * len(connected))}")
+    print(f" Max burst: {max_burst} packets")
+    print()
+    await asyncio.gather(*[udp_probe.run(test_limit) for udp_probe in connected])
+
+  try:
+    asyncio.run(run())
   except KeyboardInterrupt:
     pass
 
-  print(f"Total sent {total_num_sent}, total lost {total_num_lost}, total reorder {total_num_reorders}")
-  os._exit(0)
+  for udp_probe in connected:
+    print()
+    print(f"{udp_probe.label}:")
+    udp_probe.print_summary()
+
+def parse_target(spec):
+  (host, sep, port) = spec.strip().rpartition(":")
+  if sep == "" or host == "" or not port.isdigit():
+    raise ValueError(f"Invalid target '{spec}', expecting host:port")
+  return (spec.strip(), socket.gethostbyname(host), int(port))
+
+def read_targets_file(path):
+  with open(path) as f:
+    lines = [line.split("#", 1)[0].strip() for line in f]
+  return [line for line in lines if line != ""]
 
 def main():
   parser = ArgumentParser(description='Metaplay Debug UDP test tool.')
-  parser.add_argument('host', nargs=1)
-  parser.add_argument('port', nargs=1)
+  parser.add_argument('host', nargs='?')
+  parser.add_argument('port', nargs='?')
+  parser.add_argument('-targets', nargs='+', default=[], help="Probe all these host:port targets at the same time")
+  parser.add_argument('-targets-file', default=None, help="File with one host:port target per line to probe at the same time")
   parser.add_argument('-rate', default=100, help="Num packets per second")
   parser.add_argument('-size', default=100, help="Packet size")
   parser.add_argument('-count', default=None, help="For how many seconds to run")
+  parser.add_argument('-workers', default=None, help="Number of worker processes, each probing the target from its own socket at -rate")
+  parser.add_argument('-kernel-timestamps', default=False, action='store_true', help="Use kernel receive timestamps (SO_TIMESTAMPNS, Linux only) and report the delay until the tool sees each reply")
+  parser.add_argument('-sweep', default=None, help="Capacity search: raise the rate from -rate up to this many packets/s until loss or latency breaks")
+  parser.add_argument('-sweep-step', default=None, help="Raise the sweep rate by this many packets/s per level, default is doubling")
+  parser.add_argument('-sweep-hold', default=5, help="Seconds to measure each sweep level")
+  parser.add_argument('-sweep-settle', default=2, help="Seconds to wait after changing the sweep rate before measuring")
+  parser.add_argument('-max-loss', default=1.0, help="Sweep limit: max packet loss percent")
+  parser.add_argument('-max-p99', default=50.0, help="Sweep limit: max p99 ping in milliseconds")
+  parser.add_argument('-capture', default=None, help="Write every packet's send and receive timestamps to this binary capture file (suffixed with .N per worker or target)")
+  parser.add_argument('-analyze', default=None, help="Analyze a capture file written with -capture instead of running a test")
+  parser.add_argument('-window', default=1.0, help="With -analyze: length of the reporting windows in seconds")
+  parser.add_argument('-from', dest='from_seconds', default=0.0, help="With -analyze: start of the analyzed range, in seconds from the start of the run")
+  parser.add_argument('-to', dest='to_seconds', default=None, help="With -analyze: end of the analyzed range, in seconds from the start of the run")
+  parser.add_argument('-burst', default=None, help="Max packets to send back-to-back when catching up with the schedule, default is 2ms worth of packets (min 8)")
 
   args = parser.parse_args()
-  ipv4 = socket.gethostbyname(args.host[0])
-  port = int(args.port[0])
+  if args.analyze is not None:
+    try:
+      analyze_capture(args.analyze, float(args.window), float(args.from_seconds), None if args.to_seconds is None else float(args.to_seconds))
+    except (OSError, ValueError) as ex:
+      print(f"Failed to analyze {args.analyze}: {ex}")
+      sys.exit(1)
+    return
+
   packet_len = int(args.size)
   packet_rate = int(args.rate)
   test_limit = None if args.count is None else int(args.count)
+  burst_for_rate = lambda rate: default_max_burst(rate) if args.burst is None else max(1, int(args.burst))
+  max_burst = burst_for_rate(packet_rate)
+
+  kernel_timestamps = args.kernel_timestamps
+  if kernel_timestamps and not sys.platform.startswith("linux"):
+    parser.error("-kernel-timestamps is only supported on Linux")
+  num_workers = None if args.workers is None else int(args.workers)
+  if num_workers is not None and num_workers < 1:
+    parser.error("-workers must be at least 1")
+
+  target_specs = list(args.targets)
+  if args.targets_file is not None:
+    target_specs += read_targets_file(args.targets_file)
+  if len(target_specs) > 0:
+    if num_workers is not None or args.sweep is not None:
+      parser.error("-workers and -sweep cannot be combined with -targets or -targets-file")
+    if args.host is not None:
+      target_specs.insert(0, f"{args.host}:{args.port}")
+    try:
+      targets = [parse_target(spec) for spec in target_specs]
+    except (ValueError, socket.gaierror) as ex:
+      parser.error(str(ex))
+    test_fleet(targets, packet_len, packet_rate, test_limit, max_burst, kernel_timestamps, args.capture)
+    return
 
-  test(ipv4, port, packet_len, packet_rate, test_limit)
+  if args.host is None or args.port is None:
+    parser.error("host and port are required unless -targets or -targets-file is given")
+  ipv4 = socket.gethostbyname(args.host)
+  port = int(args.port)
+  if args.sweep is not None:
+    if num_workers is not None:
+      parser.error("-sweep cannot be combined with -workers")
+    sweep_max = int(args.sweep)
+    if sweep_max < packet_rate:
+      parser.error("-sweep must be at least -rate")
+    sweep_step = None if args.sweep_step is None else int(args.sweep_step)
+    test_sweep(ipv4, port, packet_len, packet_rate, sweep_max, sweep_step, int(args.sweep_hold), int(args.sweep_settle), float(args.max_loss), float(args.max_p99), burst_for_rate, kernel_timestamps, args.capture)
+  elif num_workers is not None:
+    test_workers(ipv4, port, packet_len, packet_rate, test_limit, max_burst, kernel_timestamps, args.capture, num_workers)
+  else:
+    test(ipv4, port, packet_len, packet_rate, test_limit, max_burst, kernel_timestamps, args.capture)
 
 if __name__ == '__main__':
     main()